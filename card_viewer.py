@@ -1,17 +1,144 @@
 import os
 import json
+import time
+import gzip
+import zlib
+import mmap
+import bisect
+import hashlib
+import asyncio
+import argparse
+import queue
+import threading
+from collections import deque, OrderedDict
+from datetime import datetime
+from email.utils import formatdate, parsedate_to_datetime
+from urllib.parse import urlsplit, parse_qs
+from http import HTTPStatus
+from http.client import HTTPMessage
+from email.parser import Parser
+from concurrent.futures import ThreadPoolExecutor
 from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 
-from metaflow import S3, metaflow_config, profile, Task, namespace
+from metaflow import profile, Task, Step, namespace
 from metaflow.cards import get_cards
+from metaflow.exception import MetaflowNotFound
 
-TASK_CACHE = {}
+from viewer_datastore import make_datastore, LocalStore, DATASTORE_POOL_SIZE
+from viewer_metrics import Metrics
 
+# Number of task timestamps and finished tasks remembered by the viewer.
+TASK_CACHE_SIZE = 50000
 
-class RequestHandler(BaseHTTPRequestHandler):
-    def do_GET(self):
+# Seconds between two background scans of the latest run's card prefix.
+INDEX_REFRESH_INTERVAL = 2
+
+# Scans that find nothing new double the time to the next background scan,
+# up to these many seconds while someone asks for the run (a request in the
+# last INDEX_IDLE_TIMEOUT seconds), and up to INDEX_MAX_INTERVAL otherwise.
+INDEX_WATCHED_MAX_INTERVAL = 10
+INDEX_MAX_INTERVAL = 120
+INDEX_IDLE_TIMEOUT = 60
+
+# How long a request waits for the very first scan before answering.
+INDEX_READY_TIMEOUT = 30
+
+# Number of runs whose card index is kept in memory; the latest run is always
+# indexed, in the background.
+RUN_INDEX_CACHE_SIZE = 32
+
+# Seconds between two checks of `.metaflow` for new flows and runs.
+CATALOG_REFRESH_INTERVAL = 2
+
+# Default and largest page size of `/runs` and of a filtered `/runinfo`.
+PAGE_SIZE = 50
+MAX_PAGE_SIZE = 500
+
+# Filtered views of a run kept per update of its index; the filters come from
+# the query string, so any number of them can be asked for.
+RUN_VIEW_CACHE_SIZE = 16
+
+# Query parameters of `/runinfo` that select a page of filtered cards instead
+# of every card of the run.
+RUNINFO_FILTERS = ("step", "type", "name", "task_from", "task_to", "sort", "page", "page_size")
+
+# Seconds between two checks of a watched runtime data object.
+WATCH_INTERVAL = 1
+
+# Seconds of silence after which a keep-alive comment is sent on a stream.
+STREAM_KEEPALIVE = 15
+
+STREAM_HEADERS = (
+    ("Content-type", "text/event-stream"),
+    ("Cache-Control", "no-cache"),
+    ("Connection", "keep-alive"),
+)
+STREAM_KEEPALIVE_EVENT = b": keep-alive\n\n"
+
+# Number of past versions of a runtime data object for which a delta can
+# still be served; older `since` versions get the full payload.
+DELTA_HISTORY = 64
+
+# Seconds after which a data feed without subscribers or requests is dropped.
+FEED_IDLE_TIMEOUT = 300
+
+# Bodies smaller than this are not worth compressing.
+COMPRESS_MIN_SIZE = 1024
+
+# Total size of the bodies kept in memory by the blob cache.
+CACHE_MAX_BYTES = 256 * 1024 * 1024
+
+# Seconds a cached runtime card or data body is served without checking the
+# datastore again. Final cards stay cached until they are evicted.
+RUNTIME_TTL = 2
+
+# A card is final once its task finished and the card object has not been
+# rewritten for this many seconds (the final render happens after the task).
+FINAL_CARD_GRACE = 120
+
+# Browser cache lifetime of a final card.
+FINAL_CARD_MAX_AGE = 3600
+
+# Encodings we can produce, in order of preference.
+ENCODINGS = ("gzip", "deflate")
+
+# With `--datastore local`, cards at least this large are streamed from their
+# file instead of being read into memory and cached.
+LOCAL_STREAM_MIN_SIZE = 64 * 1024
+
+# Size of the pieces a streamed card is read and compressed in.
+STREAM_CHUNK_SIZE = 64 * 1024
+
+# Requests the asyncio server handles at once; streams are not counted since
+# an idle subscriber holds no thread.
+ASYNC_MAX_CONCURRENCY = 64
+
+# Seconds an idle keep-alive connection stays open, on either server.
+IDLE_TIMEOUT = 60
+
+
+class CardRoutes(object):
+    """
+    Route implementations shared by the threaded and the asyncio server.
+
+    Subclasses provide `headers`, `_response` and `send_error`; `dispatch`
+    parses `self.path` and calls the matching route.
+    """
+
+    def dispatch(self):
+        prefix, suffix = self._route()
+        if prefix in self.ROUTES:
+            self.ROUTES[prefix](self, suffix)
+        else:
+            self.get_index(suffix)
+
+    def _route(self):
+        url = urlsplit(self.path)
+        self.query = parse_qs(url.query)
+        self.status = None
+        self.bytes_sent = 0
         try:
-            _, path = self.path.split("/", 1)
+            _, path = url.path.split("/", 1)
             try:
                 prefix, suffix = path.split("/", 1)
             except:
@@ -19,117 +146,1576 @@ class RequestHandler(BaseHTTPRequestHandler):
                 suffix = None
         except:
             prefix = None
-        if prefix in self.ROUTES:
-            self.ROUTES[prefix](self, suffix)
-        else:
-            with open("index.html", "rb") as f:
-                self._response(f.read())
+            suffix = None
+        # Label used by the metrics; unknown paths all serve the index page.
+        self.route = prefix if prefix in self.ROUTES or prefix == "stream" else "index"
+        return prefix, suffix
+
+    def get_index(self, suffix):
+        with open("index.html", "rb") as f:
+            self._response(f.read())
 
     def get_runinfo(self, suffix):
-        print("Gettin run info")
-        latest = find_latest_run()
-        print("found latest run")
-        if latest:
-            flow, run_id = latest
-            cardsx = list(find_cards(flow, run_id))
-            print(cardsx)
-            cards = [
-                {"label": "%s/%s %s" % (step, task_id, name), "card": card_id}
-                for _, step, task_id, name, card_id in sorted(
-                    cardsx, reverse=True
-                )
+        flow = run_id = None
+        if suffix:
+            try:
+                flow, run_id = suffix.split("/")
+            except ValueError:
+                self.send_error(404)
+                return
+            RUN_CATALOG.refresh(max_age=CATALOG_REFRESH_INTERVAL)
+            if not RUN_CATALOG.has_run(flow, run_id):
+                self.send_error(404)
+                return
+        if not any(name in self.query for name in RUNINFO_FILTERS):
+            self._response(CARD_INDEX.runinfo(flow, run_id), is_json=True)
+            return
+        paging = self._paging()
+        sort = self._param("sort", "time")
+        if paging is None or sort not in ("time", "task"):
+            self.send_error(400)
+            return
+        run = CARD_INDEX.run_index(flow, run_id)
+        if run is None:
+            self._response({"status": "no runs"}, is_json=True)
+            return
+        response = run.query(
+            step=self._param("step"),
+            card_type=self._param("type"),
+            name=self._param("name"),
+            task_from=self._param("task_from"),
+            task_to=self._param("task_to"),
+            sort=sort,
+            page=paging[0],
+            page_size=paging[1],
+        )
+        self._response(response, is_json=True)
+
+    def get_runs(self, suffix):
+        paging = self._paging()
+        if paging is None:
+            self.send_error(400)
+            return
+        page, page_size = paging
+        RUN_CATALOG.refresh(max_age=CATALOG_REFRESH_INTERVAL)
+        start = (page - 1) * page_size
+        flow = self._param("flow")
+        response = {"status": "ok", "page": page, "page_size": page_size}
+        if flow is None:
+            flows = RUN_CATALOG.flows()
+            response["total"] = len(flows)
+            response["flows"] = [
+                {"flow": entry.name, "latest_run": entry.latest_run, "runs": len(entry.runs)}
+                for entry in flows[start : start + page_size]
             ]
-            print(cards)
-            resp = {"status": "ok", "flow": flow, "run_id": run_id, "cards": cards}
         else:
-            resp = {"status": "no runs"}
-        self._response(resp, is_json=True)
+            entry = RUN_CATALOG.get(flow)
+            if entry is None:
+                self.send_error(404)
+                return
+            response["flow"] = flow
+            response["total"] = len(entry.runs)
+            response["runs"] = [
+                {"run_id": run_id, "latest": run_id == entry.latest_run}
+                for run_id in entry.runs[start : start + page_size]
+            ]
+        self._response(response, is_json=True)
 
     def get_card(self, suffix):
         flow, run_id, step, task_id, fname = suffix.split("/")
-        url = os.path.join(
-            metaflow_config.CARD_S3ROOT,
-            flow,
-            "runs",
-            run_id,
-            "steps",
-            step,
-            "tasks",
-            task_id,
-            "cards",
-            fname + ".html",
-        )
-        with S3() as s3:
-            self._response(s3.get(url).blob)
+        url = card_url(flow, run_id, step, task_id, fname)
+        pathspec = "/".join((flow, run_id, step, task_id))
+        if isinstance(DATASTORE, LocalStore):
+            with METRICS.timer("datastore_open"):
+                f, info = DATASTORE.open(url)
+            if f is not None and info.size >= LOCAL_STREAM_MIN_SIZE:
+                self._send_card_file(f, info, pathspec)
+                return
+            if f is not None:
+                f.close()
+        entry = BLOB_CACHE.get(url)
+        if entry is None:
+            entry = FLIGHTS.do(("card", url), load_card, url, pathspec)
+            if entry is None:
+                self.send_error(404)
+                return
+        validators = card_validators(entry.version, entry.last_modified, entry.final)
+        if self._not_modified(entry.version, entry.last_modified):
+            self._response(b"", status=304, headers=validators)
+            return
+        encoding = self._encoding(entry.size)
+        if encoding:
+            compressed = BLOB_CACHE.get((url, encoding), entry.version)
+            if compressed is None:
+                compressed = BLOB_CACHE.put(
+                    (url, encoding),
+                    compress(entry.value, encoding),
+                    entry.version,
+                    final=entry.final,
+                )
+            entry = compressed
+        self._response(entry.value, headers=validators, encoding=encoding)
+
+    def _send_card_file(self, f, info, pathspec):
+        # Large local cards go from the file to the socket with sendfile, so
+        # memory per request does not grow with the card. Compressed ones are
+        # compressed once per version and served from the blob cache.
+        etag = object_etag(info)
+        final = is_final_card(info, pathspec)
+        validators = card_validators(etag, info.last_modified, final)
+        if self._not_modified(etag, info.last_modified):
+            f.close()
+            self._response(b"", status=304, headers=validators)
+            return
+        encoding = self._encoding(info.size)
+        if not encoding:
+            self._file_response(f, info.size, validators)
+            return
+        with f:
+            key = (info.url, encoding)
+            entry = BLOB_CACHE.get(key, etag)
+            if entry is None:
+                # Keyed on the version too, so that a request for a rewritten
+                # card never joins the compression of the previous one.
+                entry = FLIGHTS.do(
+                    ("compress", etag) + key, self._compress_file, f, key, etag, final
+                )
+        self._response(entry.value, headers=validators, encoding=encoding)
+
+    @staticmethod
+    def _compress_file(f, key, etag, final):
+        with METRICS.timer("compress"):
+            body = b"".join(compressed_chunks(f, key[1]))
+        return BLOB_CACHE.put(key, body, etag, final=final)
 
     def get_data(self, suffix):
-        flow, run_id, step, task_id, fname = suffix.split("/")
-        url = os.path.join(
-            metaflow_config.CARD_S3ROOT,
-            flow,
-            "runs",
-            run_id,
-            "steps",
-            step,
-            "tasks",
-            task_id,
-            "runtime",
-            fname + ".data.json",
-        )
-        with S3() as s3:
-            obj = s3.get(url, return_missing=True)
-            if obj.exists:
-                self._response({'status': 'ok', 'payload': json.loads(obj.blob)}, is_json=True)
+        url = data_url(*suffix.split("/"))
+        feed = DATA_FEEDS.get(url)
+        feed.refresh(max_age=RUNTIME_TTL)
+        since = self._param("since")
+        message = feed.message(since)
+        if "version" not in message:
+            self._response(message, is_json=True)
+            return
+        etag = '"%s"' % message["version"]
+        validators = {"ETag": etag, "Cache-Control": "no-cache"}
+        if self._not_modified(etag):
+            self._response(b"", status=304, headers=validators)
+            return
+        # Clients polling in step ask for the same (since, version) pair, so
+        # the serialized and compressed body is shared between them.
+        encoding = self._encoding(COMPRESS_MIN_SIZE)
+        key = (url, since, encoding)
+        entry = BLOB_CACHE.get(key, etag)
+        if entry is None:
+            body = json.dumps(message).encode("utf-8")
+            if encoding and len(body) >= COMPRESS_MIN_SIZE:
+                body = compress(body, encoding)
             else:
-                self._response({'status': 'not found'}, is_json=True)
+                encoding = None
+            entry = BLOB_CACHE.put(key, body, etag, encoding=encoding)
+        self._response(
+            entry.value, is_json=True, headers=validators, encoding=entry.encoding
+        )
+
+    def get_cache(self, suffix):
+        self._response(BLOB_CACHE.stats(), is_json=True)
+
+    def get_metrics(self, suffix):
+        caches = {
+            "blob_cache": BLOB_CACHE.stats(),
+            "task_cache": {"entries": len(TASK_CACHE)},
+        }
+        if self._param("format", "json") == "prometheus":
+            self._response(
+                METRICS.prometheus(caches).encode("utf-8"),
+                content_type="text/plain; version=0.0.4",
+            )
+        else:
+            self._response(METRICS.snapshot(caches), is_json=True)
+
+    def _param(self, name, default=None):
+        values = self.query.get(name)
+        return values[0] if values else default
+
+    def _paging(self):
+        # Returns (page, page_size) from the query, None if they are invalid.
+        try:
+            page = int(self._param("page", 1))
+            page_size = min(int(self._param("page_size", PAGE_SIZE)), MAX_PAGE_SIZE)
+        except ValueError:
+            return None
+        if page < 1 or page_size < 1:
+            return None
+        return page, page_size
+
+    def _encoding(self, size):
+        # Picks the preferred encoding accepted by the client, honoring q=0.
+        if size < COMPRESS_MIN_SIZE:
+            return None
+        accepted = {}
+        for item in self.headers.get("Accept-Encoding", "").split(","):
+            name, _, params = item.strip().partition(";")
+            quality = 1.0
+            if params.strip().startswith("q="):
+                try:
+                    quality = float(params.strip()[2:])
+                except ValueError:
+                    quality = 0.0
+            accepted[name.strip().lower()] = quality
+        for encoding in ENCODINGS:
+            if accepted.get(encoding, accepted.get("*", 0)) > 0:
+                return encoding
+        return None
+
+    def _not_modified(self, etag, last_modified=None):
+        match = self.headers.get("If-None-Match")
+        if match is not None:
+            tags = [tag.strip() for tag in match.split(",")]
+            return "*" in tags or etag in tags or "W/" + etag in tags
+        since = self.headers.get("If-Modified-Since")
+        if since and last_modified is not None:
+            try:
+                return int(last_modified) <= parsedate_to_datetime(since).timestamp()
+            except (TypeError, ValueError):
+                return False
+        return False
+
+    def _response_headers(
+        self, body, is_json=False, status=200, headers=None, encoding=None, content_type=None
+    ):
+        # Returns the headers and the encoded body of a response.
+        out = []
+        if status != 304:
+            mime = content_type or ("application/json" if is_json else "text/html")
+            out.append(("Content-type", mime))
+            if is_json and not isinstance(body, bytes):
+                body = json.dumps(body).encode("utf-8")
+            out.append(("Content-Length", str(len(body))))
+            if encoding:
+                out.append(("Content-Encoding", encoding))
+            out.append(("Vary", "Accept-Encoding"))
+        else:
+            body = b""
+        out.extend((headers or {}).items())
+        self.status = status
+        self.bytes_sent = len(body)
+        return out, body
+
+    def _file_headers(self, size, headers=None):
+        out = [("Content-type", "text/html")]
+        out.append(("Content-Length", str(size)))
+        out.append(("Vary", "Accept-Encoding"))
+        out.extend((headers or {}).items())
+        self.status = 200
+        self.bytes_sent = size
+        return out
 
-    def _response(self, body, is_json=False):
+    ROUTES = {
+        "runinfo": get_runinfo,
+        "runs": get_runs,
+        "card": get_card,
+        "data": get_data,
+        "cache": get_cache,
+        "metrics": get_metrics,
+    }
+
+
+class RequestHandler(CardRoutes, BaseHTTPRequestHandler):
+    # Keep-alive connections; every response other than streams has a length.
+    protocol_version = "HTTP/1.1"
+    # Headers and body are separate writes; with Nagle on, the body of every
+    # keep-alive response waits for the client's delayed ACK.
+    disable_nagle_algorithm = True
+    # Each keep-alive connection holds a thread until it is closed.
+    timeout = IDLE_TIMEOUT
+
+    def do_GET(self):
+        start = time.perf_counter()
+        prefix, suffix = self._route()
+        if prefix == "stream":
+            self.get_stream(suffix)
+            return
+        try:
+            self.dispatch()
+        finally:
+            METRICS.request(
+                self.route,
+                self.status or 500,
+                self.bytes_sent,
+                time.perf_counter() - start,
+            )
+
+    def send_response(self, code, message=None):
+        # Also called by `send_error`, so the metrics see every status.
+        self.status = code
+        super().send_response(code, message)
+
+    def get_stream(self, suffix):
+        # Server-Sent Events: the connection stays open and a new event is
+        # pushed whenever the shared watcher of the card sees new data. After
+        # the first event only deltas are sent; a reconnecting browser resumes
+        # from `Last-Event-ID`.
+        url = stream_url(suffix)
+        if url is None:
+            self.send_error(404)
+            return
+        since = self.headers.get("Last-Event-ID") or self._param("since")
+        self.close_connection = True
         self.send_response(200)
-        mime = "application/json" if is_json else "text/html"
-        self.send_header("Content-type", mime)
+        for name, value in STREAM_HEADERS:
+            self.send_header(name, value)
         self.end_headers()
-        if is_json:
-            self.wfile.write(json.dumps(body).encode("utf-8"))
+        events = queue.Queue()
+        feed = DATA_FEEDS.subscribe(url, events)
+        METRICS.add("open_streams", 1)
+        try:
+            while True:
+                try:
+                    events.get(timeout=STREAM_KEEPALIVE)
+                    # Several updates may have piled up, one event covers all.
+                    while not events.empty():
+                        events.get_nowait()
+                    since, message = stream_event(feed, since)
+                    if message is None:
+                        continue
+                except queue.Empty:
+                    message = STREAM_KEEPALIVE_EVENT
+                self.wfile.write(message)
+                self.wfile.flush()
+                METRICS.sent("stream", len(message))
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+        finally:
+            METRICS.add("open_streams", -1)
+            DATA_FEEDS.unsubscribe(feed, events)
+
+    def _response(
+        self, body, is_json=False, status=200, headers=None, encoding=None, content_type=None
+    ):
+        headers, body = self._response_headers(
+            body, is_json, status, headers, encoding, content_type
+        )
+        self.send_response(status)
+        for name, value in headers:
+            self.send_header(name, value)
+        self.end_headers()
+        if body:
+            self.wfile.write(body)
+
+    def _file_response(self, f, size, headers=None):
+        with f:
+            self.send_response(200)
+            for name, value in self._file_headers(size, headers):
+                self.send_header(name, value)
+            self.end_headers()
+            self.connection.sendfile(f, 0, size)
+
+
+class AsyncRequest(CardRoutes):
+    """
+    One request of the asyncio server. Routes run in the executor and leave
+    their response in `self.response` for the event loop to write.
+    """
+
+    def __init__(self, command, path, headers, request_version="HTTP/1.1"):
+        self.command = command
+        self.path = path
+        self.headers = headers
+        self.request_version = request_version
+        self.response = None
+
+    @property
+    def keep_alive(self):
+        # As in `BaseHTTPRequestHandler`: HTTP/1.0 clients must ask for it.
+        connection = self.headers.get("Connection", "").lower()
+        if connection == "close":
+            return False
+        return self.request_version != "HTTP/1.0" or connection == "keep-alive"
+
+    def send_error(self, code):
+        status = HTTPStatus(code)
+        body = ("%d %s" % (status.value, status.phrase)).encode("utf-8")
+        self._response(body, status=code)
+
+    def _response(
+        self, body, is_json=False, status=200, headers=None, encoding=None, content_type=None
+    ):
+        headers, body = self._response_headers(
+            body, is_json, status, headers, encoding, content_type
+        )
+        self.response = (status, headers, body, None)
+
+    def _file_response(self, f, size, headers=None):
+        headers = self._file_headers(size, headers)
+        self.response = (200, headers, b"", (f, size))
+
+
+class AsyncEvents(object):
+    # Lets a feed (running in a watcher thread) wake up a coroutine.
+    def __init__(self, loop):
+        self.loop = loop
+        self.queue = asyncio.Queue()
+
+    def put(self, version):
+        self.loop.call_soon_threadsafe(self.queue.put_nowait, version)
+
+
+class AsyncCardServer(object):
+    """
+    asyncio implementation of the viewer serving the same routes as
+    `RequestHandler`, with HTTP/1.1 keep-alive.
+
+    Connections and `/stream` subscribers are coroutines, so thousands of
+    idle watchers cost no threads. Routes that touch the datastore run in a
+    thread pool, at most `max_concurrency` at a time.
+    """
+
+    def __init__(self, host, port, max_concurrency=ASYNC_MAX_CONCURRENCY):
+        self.host = host
+        self.port = port
+        self.max_concurrency = max_concurrency
+        self._executor = ThreadPoolExecutor(max_workers=max_concurrency)
+        self._semaphore = None
+
+    def serve_forever(self):
+        asyncio.run(self._serve())
+
+    async def _serve(self):
+        self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        server = await asyncio.start_server(self._handle, self.host, self.port)
+        async with server:
+            await server.serve_forever()
+
+    async def _handle(self, reader, writer):
+        try:
+            while True:
+                request = await self._read_request(reader)
+                if request is None:
+                    break
+                if request.response is not None:
+                    # Malformed request line or method other than GET,
+                    # answered without keep-alive.
+                    status, headers, body, _ = request.response
+                    if request.command == "HEAD":
+                        body = b""
+                    await self._write(writer, (status, headers, body, None), False)
+                    break
+                prefix, suffix = request._route()
+                start = time.perf_counter()
+                if prefix == "stream":
+                    url = stream_url(suffix)
+                    if url is not None:
+                        await self._stream(request, url, reader, writer)
+                        break
+                    request.send_error(404)
+                else:
+                    async with self._semaphore:
+                        await asyncio.get_running_loop().run_in_executor(
+                            self._executor, self._dispatch, request
+                        )
+                keep_alive = request.keep_alive
+                nbytes = await self._write(writer, request.response, keep_alive)
+                METRICS.request(
+                    request.route,
+                    request.response[0],
+                    nbytes,
+                    time.perf_counter() - start,
+                )
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.TimeoutError):
+            pass
+        finally:
+            writer.close()
+
+    def _dispatch(self, request):
+        try:
+            request.dispatch()
+        except Exception as ex:
+            print("%s %s failed: %s" % (request.command, request.path, ex))
+            request.send_error(500)
+
+    async def _read_request(self, reader):
+        line = await asyncio.wait_for(reader.readline(), IDLE_TIMEOUT)
+        if not line:
+            return None
+        try:
+            command, path, version = line.decode("latin-1").rstrip("\r\n").split(" ", 2)
+            if not version.startswith("HTTP/"):
+                raise ValueError(version)
+        except ValueError:
+            request = AsyncRequest(None, None, HTTPMessage())
+            request.send_error(400)
+            return request
+        lines = []
+        while True:
+            line = await reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+            lines.append(line.decode("latin-1"))
+        headers = Parser(_class=HTTPMessage).parsestr("".join(lines))
+        request = AsyncRequest(command, path, headers, version)
+        if command != "GET":
+            # Like `RequestHandler`, which only implements do_GET.
+            request.send_error(501)
+        return request
+
+    async def _write(self, writer, response, keep_alive):
+        status, headers, body, source = response
+        head = ["HTTP/1.1 %d %s" % (status, HTTPStatus(status).phrase)]
+        head.append("Date: %s" % formatdate(usegmt=True))
+        head.extend("%s: %s" % header for header in headers)
+        if not keep_alive:
+            head.append("Connection: close")
+        writer.write(("\r\n".join(head) + "\r\n\r\n").encode("latin-1") + body)
+        await writer.drain()
+        if source is not None:
+            return await self._write_file(writer, *source)
+        return len(body)
+
+    async def _write_file(self, writer, f, size):
+        # Returns the number of body bytes sent.
+        with f:
+            return await asyncio.get_running_loop().sendfile(writer.transport, f, 0, size)
+
+    async def _stream(self, request, url, reader, writer):
+        since = request.headers.get("Last-Event-ID") or request._param("since")
+        head = ["HTTP/1.1 200 OK"] + ["%s: %s" % header for header in STREAM_HEADERS]
+        writer.write(("\r\n".join(head) + "\r\n\r\n").encode("latin-1"))
+        await writer.drain()
+        events = AsyncEvents(asyncio.get_running_loop())
+        feed = DATA_FEEDS.subscribe(url, events)
+        METRICS.add("open_streams", 1)
+        # Completes when the client goes away, so that idle subscribers are
+        # dropped right away rather than at the next write.
+        closed = asyncio.ensure_future(reader.read())
+        try:
+            while not closed.done():
+                update = asyncio.ensure_future(events.queue.get())
+                await asyncio.wait(
+                    (update, closed),
+                    timeout=STREAM_KEEPALIVE,
+                    return_when=asyncio.FIRST_COMPLETED,
+                )
+                if not update.done():
+                    update.cancel()
+                    message = STREAM_KEEPALIVE_EVENT
+                else:
+                    while not events.queue.empty():
+                        events.queue.get_nowait()
+                    since, message = stream_event(feed, since)
+                    if message is None:
+                        continue
+                if closed.done():
+                    break
+                writer.write(message)
+                await writer.drain()
+                METRICS.sent("stream", len(message))
+        finally:
+            closed.cancel()
+            METRICS.add("open_streams", -1)
+            DATA_FEEDS.unsubscribe(feed, events)
+
+
+def _task_url(flow, run_id, step, task_id, *parts):
+    return DATASTORE.url(
+        flow,
+        "runs",
+        run_id,
+        "steps",
+        step,
+        "tasks",
+        task_id,
+        *parts
+    )
+
+
+def card_url(flow, run_id, step, task_id, fname):
+    return _task_url(flow, run_id, step, task_id, "cards", fname + ".html")
+
+
+def data_url(flow, run_id, step, task_id, fname):
+    return _task_url(flow, run_id, step, task_id, "runtime", fname + ".data.json")
+
+
+def stream_url(suffix):
+    # Data object watched by /stream/<flow>/<run_id>/<step>/<task_id>/<card>,
+    # None for any other path.
+    parts = (suffix or "").split("/")
+    if len(parts) != 5 or not all(parts):
+        return None
+    return data_url(*parts)
+
+
+def object_etag(obj):
+    # Strong validator derived from the object's metadata, no download needed.
+    stamp = "%s:%s:%s" % (obj.url, obj.size, obj.last_modified)
+    return '"%s"' % hashlib.sha1(stamp.encode("utf-8")).hexdigest()
+
+
+def compress(body, encoding):
+    if encoding == "gzip":
+        return gzip.compress(body, mtime=0)
+    return zlib.compress(body)
+
+
+def compressed_chunks(f, encoding, chunk_size=STREAM_CHUNK_SIZE):
+    # Compresses an open file through a memory map, one chunk at a time.
+    compressor = zlib.compressobj(wbits=31 if encoding == "gzip" else 15)
+    if os.fstat(f.fileno()).st_size:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            for offset in range(0, len(mm), chunk_size):
+                chunk = compressor.compress(mm[offset : offset + chunk_size])
+                if chunk:
+                    yield chunk
+    yield compressor.flush()
+
+
+def card_validators(etag, last_modified, final):
+    # Runtime cards are re-rendered in place while the task runs, so
+    # browsers always revalidate them; an unchanged card costs a 304.
+    return {
+        "ETag": etag,
+        "Last-Modified": formatdate(last_modified, usegmt=True),
+        "Cache-Control": "public, max-age=%d" % FINAL_CARD_MAX_AGE
+        if final
+        else "no-cache",
+    }
+
+
+class SingleFlight(object):
+    """
+    Coalesces concurrent calls for the same key: the first caller runs the
+    function, the others wait for it and share its result (or exception).
+    """
+
+    class _Call(object):
+        def __init__(self):
+            self.done = threading.Event()
+            self.result = None
+            self.error = None
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def do(self, key, fn, *args):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = self._Call()
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+        try:
+            call.result = fn(*args)
+            return call.result
+        except Exception as ex:
+            call.error = ex
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+
+class CacheEntry(object):
+    __slots__ = ("value", "version", "size", "final", "expires", "last_modified", "encoding")
+
+    def __init__(self, value, version, final, expires, last_modified, encoding):
+        self.value = value
+        self.version = version
+        self.size = len(value)
+        self.final = final
+        self.expires = expires
+        self.last_modified = last_modified
+        self.encoding = encoding
+
+
+class BlobCache(object):
+    """
+    LRU of card and data bodies bounded by their total size in bytes.
+
+    Every entry carries the version (ETag) of the object it was read from; a
+    lookup for another version drops the entry. Final entries are kept until
+    they are evicted, runtime entries expire after `runtime_ttl` seconds and
+    can then be revalidated against the object's current version.
+    """
+
+    def __init__(self, max_bytes=CACHE_MAX_BYTES, runtime_ttl=RUNTIME_TTL):
+        self.max_bytes = max_bytes
+        self.runtime_ttl = runtime_ttl
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.revalidations = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+
+    def get(self, key, version=None):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and version is not None and entry.version != version:
+                self._drop(key)
+                entry = None
+            if entry is None or (entry.expires is not None and entry.expires < time.time()):
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def revalidate(self, key, version, final=False):
+        # Extends an expired entry whose object did not change since.
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry.version != version:
+                return None
+            entry.final = entry.final or final
+            entry.expires = self._expires(entry.final)
+            self._entries.move_to_end(key)
+            self.revalidations += 1
+            return entry
+
+    def put(self, key, value, version, final=False, last_modified=None, encoding=None):
+        entry = CacheEntry(
+            value, version, final, self._expires(final), last_modified, encoding
+        )
+        if entry.size > self.max_bytes:
+            return entry
+        with self._lock:
+            if key in self._entries:
+                self._drop(key)
+            self._entries[key] = entry
+            self.bytes += entry.size
+            while self.bytes > self.max_bytes:
+                self._drop(next(iter(self._entries)))
+                self.evictions += 1
+        return entry
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "bytes": self.bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": self.hits / lookups if lookups else 0.0,
+                "revalidations": self.revalidations,
+                "evictions": self.evictions,
+            }
+
+    def _expires(self, final):
+        return None if final else time.time() + self.runtime_ttl
+
+    def _drop(self, key):
+        self.bytes -= self._entries.pop(key).size
+
+
+def _mtime(path):
+    try:
+        return os.stat(path).st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+
+class FlowRuns(object):
+    # Runs of one flow, newest first, and the mtimes they were listed at.
+    __slots__ = ("name", "runs", "latest_run", "mtime", "latest_mtime")
+
+    def __init__(self, name, runs, latest_run, mtime, latest_mtime):
+        self.name = name
+        self.runs = runs
+        self.latest_run = latest_run
+        self.mtime = mtime
+        self.latest_mtime = latest_mtime
+
+
+class RunCatalog(object):
+    """
+    Flows and runs found in the local `.metaflow` directory.
+
+    A flow is a directory with a `latest_run` file, its runs are the
+    subdirectories holding run metadata (`_meta`). Listings are cached and
+    only redone for the directories whose mtime changed, since creating a flow
+    or a run adds an entry to its parent directory.
+    """
+
+    def __init__(self, root=".metaflow"):
+        self.root = root
+        self._flows = {}
+        # Every directory of the root, flows or not (yet): a flow directory
+        # may be created before its `latest_run` file.
+        self._dirs = []
+        self._mtime = None
+        self._checked = 0
+
+    def refresh(self, max_age=0):
+        if time.time() - self._checked < max_age:
+            return
+        FLIGHTS.do(("catalog", self.root), self._refresh)
+
+    def _refresh(self):
+        with METRICS.timer("run_catalog"):
+            mtime = _mtime(self.root)
+            if mtime != self._mtime:
+                try:
+                    self._dirs = [
+                        entry.name for entry in os.scandir(self.root) if entry.is_dir()
+                    ]
+                except FileNotFoundError:
+                    self._dirs = []
+            flows = {}
+            for name in self._dirs:
+                entry = self._refresh_flow(name, self._flows.get(name))
+                if entry is not None:
+                    flows[name] = entry
+            self._flows = flows
+            self._mtime = mtime
+            self._checked = time.time()
+
+    def _refresh_flow(self, name, entry):
+        path = os.path.join(self.root, name)
+        mtime = _mtime(path)
+        latest_mtime = _mtime(os.path.join(path, "latest_run"))
+        if latest_mtime is None:
+            return None
+        if entry is not None and (entry.mtime, entry.latest_mtime) == (mtime, latest_mtime):
+            return entry
+        try:
+            with open(os.path.join(path, "latest_run")) as f:
+                latest_run = f.read().strip()
+            # Other directories, like the `data` of the local datastore, are
+            # not runs.
+            runs = {
+                run.name
+                for run in os.scandir(path)
+                if run.is_dir() and os.path.isdir(os.path.join(run.path, "_meta"))
+            }
+        except FileNotFoundError:
+            return None
+        # With a remote metadata service only `latest_run` is stored locally.
+        runs.add(latest_run)
+        runs = sorted(
+            runs, key=lambda run_id: (run_id.isdigit(), len(run_id), run_id), reverse=True
+        )
+        return FlowRuns(name, runs, latest_run, mtime, latest_mtime)
+
+    def flows(self):
+        return [entry for _, entry in sorted(self._flows.items())]
+
+    def get(self, flow):
+        return self._flows.get(flow)
+
+    def has_run(self, flow, run_id):
+        entry = self._flows.get(flow)
+        return entry is not None and run_id in entry.runs
+
+    def latest(self):
+        # Same pick as the viewer always made: the last flow by name.
+        latest = [(entry.name, entry.latest_run) for entry in self._flows.values()]
+        return max(latest) if latest else None
+
+
+def load_card(url, pathspec):
+    with METRICS.timer("datastore_info"):
+        info = DATASTORE.info(url)
+    if info is None:
+        return None
+    etag = object_etag(info)
+    final = is_final_card(info, pathspec)
+    entry = BLOB_CACHE.revalidate(url, etag, final=final)
+    if entry is None:
+        with METRICS.timer("datastore_get"):
+            blob = DATASTORE.get(url)
+        if blob is None:
+            return None
+        entry = BLOB_CACHE.put(
+            url, blob, etag, final=final, last_modified=info.last_modified
+        )
+    return entry
+
+
+class LRUCache(object):
+    # Thread-safe mapping that forgets its least recently used keys.
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self._items = OrderedDict()
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key not in self._items:
+                return default
+            self._items.move_to_end(key)
+            return self._items[key]
+
+    def put(self, key, value):
+        with self._lock:
+            self._items[key] = value
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+
+    def __len__(self):
+        return len(self._items)
+
+
+def is_final_card(info, pathspec):
+    if time.time() - info.last_modified < FINAL_CARD_GRACE:
+        return False
+    if FINISHED_TASKS.get(pathspec) is None:
+        try:
+            task = Task(pathspec)
+            if not task.finished:
+                return False
+        except MetaflowNotFound:
+            return False
+        FINISHED_TASKS.put(pathspec, _epoch(task.finished_at))
+    return True
+
+
+def _epoch(created_at):
+    if isinstance(created_at, datetime):
+        return created_at.timestamp()
+    if isinstance(created_at, str):
+        return datetime.fromisoformat(created_at.rstrip("Z")).timestamp()
+    return float(created_at or 0)
+
+
+def task_times(flow, run_id, step, fallbacks, unfinished=()):
+    """
+    Returns the creation time (epoch seconds) of the tasks in `fallbacks`.
+
+    Tasks that are not cached yet are resolved with a single metadata call
+    listing every task of the step, which also records in `FINISHED_TASKS`
+    when the tasks of `unfinished` finished. `fallbacks` maps each task id to
+    the modification time of its card object, used for tasks the metadata
+    service does not know (yet); those are not cached so that the real value
+    wins once it is registered.
+    """
+    prefix = "/".join((flow, run_id, step))
+    times = {}
+    for task_id in fallbacks:
+        created_at = TASK_CACHE.get("%s/%s" % (prefix, task_id))
+        if created_at is not None:
+            times[task_id] = created_at
+    unfinished = [
+        task_id
+        for task_id in unfinished
+        if FINISHED_TASKS.get("%s/%s" % (prefix, task_id)) is None
+    ]
+    if len(times) < len(fallbacks) or unfinished:
+        try:
+            with METRICS.timer("task_times"):
+                for task in Step(prefix):
+                    TASK_CACHE.put(task.pathspec, _epoch(task.created_at))
+                    if FINISHED_TASKS.get(task.pathspec) is None and task.finished:
+                        FINISHED_TASKS.put(task.pathspec, _epoch(task.finished_at))
+        except MetaflowNotFound:
+            pass
+        for task_id, last_modified in fallbacks.items():
+            if task_id not in times:
+                times[task_id] = TASK_CACHE.get(
+                    "%s/%s" % (prefix, task_id), last_modified or 0
+                )
+    return times
+
+
+def _run_key(root, url):
+    # Path of a listed object relative to the root of its run.
+    return url[len(root) :].strip("/")
+
+
+def list_cards(flow, run_id, tasks):
+    """
+    Yields the card objects of a run, with keys relative to the run's root.
+
+    Steps, tasks and the `cards` directories of the tasks are listed one
+    level at a time, with one datastore call per level, so runtime data is
+    never listed. `tasks` maps "<step>/<task_id>" to the time after which a
+    task is checked again for being settled, or to None once it is: finished
+    for FINAL_CARD_GRACE, so its cards are final (see `find_cards`). Settled
+    tasks get no new cards and are not listed anymore.
+    """
+    root = DATASTORE.url(flow, "runs", run_id)
+    steps = DATASTORE.list([os.path.join(root, "steps")], recursive=False)
+    step_roots = [os.path.join(step.url, "tasks") for step in steps]
+    pending = []
+    for task in DATASTORE.list(step_roots, recursive=False):
+        _, step, _, task_id = _run_key(root, task.url).split("/")
+        if tasks.get("%s/%s" % (step, task_id), 0) is not None:
+            pending.append(os.path.join(task.url, "cards"))
+    for obj in DATASTORE.list(pending, recursive=False):
+        yield obj._replace(key=_run_key(root, obj.url))
+
+
+def find_cards(flow, run_id, seen=None, tasks=None):
+    # `seen` holds the keys that were already yielded by an earlier scan; they
+    # are skipped so that callers only pay for parsing (and `task_times`) of
+    # new cards. Cards of tasks the metadata does not know yet are yielded
+    # again by later scans, until their creation time is known. `tasks` is
+    # the state of `list_cards` kept between scans; whether a task is settled
+    # comes from the same per-step metadata call as the creation times.
+    if tasks is None:
+        tasks = {}
+    now = time.time()
+    found = []
+    steps = {}
+    due = {}
+    for obj in list_cards(flow, run_id, tasks):
+        _, step, _, task_id, _, fname = obj.key.split("/")
+        if now >= tasks.get("%s/%s" % (step, task_id), 0):
+            due.setdefault(step, set()).add(task_id)
+        if seen is not None and obj.key in seen:
+            continue
+        if obj.key.endswith(".html") and obj.size > 0:
+            name = fname.split("-")[-2]
+            pathspec = f"{flow}/{run_id}/{step}/{task_id}"
+            card_id = "%s/%s" % (pathspec, fname.split(".")[0])
+            found.append((obj.key, pathspec, step, task_id, name, card_id))
+            steps.setdefault(step, {})[task_id] = obj.last_modified
+    times = {
+        step: task_times(flow, run_id, step, steps.get(step, {}), due.get(step, ()))
+        for step in set(steps) | set(due)
+    }
+    for step, task_ids in due.items():
+        for task_id in task_ids:
+            finished_at = FINISHED_TASKS.get("/".join((flow, run_id, step, task_id)))
+            if finished_at is None:
+                check = now + FINAL_CARD_GRACE
+            else:
+                # Cards are rendered before the task finishes.
+                check = finished_at + FINAL_CARD_GRACE
+            tasks["%s/%s" % (step, task_id)] = None if now >= check else check
+    for key, pathspec, step, task_id, name, card_id in found:
+        if seen is not None:
+            if TASK_CACHE.get(pathspec) is not None:
+                seen.add(key)
+            elif tasks.get("%s/%s" % (step, task_id), 0) is None:
+                # Listed again until the metadata knows its creation time.
+                tasks["%s/%s" % (step, task_id)] = 0
+        yield times[step][task_id], step, task_id, name, card_id
+
+
+def _card_type(card_id):
+    # Card files are named "<type>-<name>-<hash>".
+    return "-".join(card_id.rsplit("/", 1)[-1].split("-")[:-2])
+
+
+def _task_key(task_id):
+    # Orders numeric task ids by value, before any other id.
+    if task_id.isdigit():
+        return (0, int(task_id), "")
+    return (1, 0, task_id)
+
+
+class RunIndex(object):
+    """
+    In-memory view of the cards of one run: steps -> tasks -> cards.
+
+    `update` only parses the keys that appeared since the previous scan and
+    rebuilds the `/runinfo` response when something changed, so serving it is
+    a plain attribute read. Filtered queries run on views of the cards, each
+    built once per update and sorted by time or task id, so a page costs a
+    bisect and a slice.
+    """
+
+    def __init__(self, flow, run_id):
+        self.flow = flow
+        self.run_id = run_id
+        self._seen = set()
+        self._tasks = {}
+        self._entries = []
+        self.updated = 0
+        self.last_access = 0
+        # Seconds to the next background scan, see `CardIndex.refresh`.
+        self.backoff = 0
+        self._build()
+
+    def update(self, max_age=0):
+        if time.time() - self.updated < max_age:
+            return False
+        return FLIGHTS.do(("cards", self.flow, self.run_id), self._update)
+
+    def _update(self):
+        with METRICS.timer("find_cards"):
+            new_entries = list(
+                find_cards(self.flow, self.run_id, seen=self._seen, tasks=self._tasks)
+            )
+        self.updated = time.time()
+        if not new_entries:
+            return False
+        # Cards yielded again come with the creation time of their task, which
+        # replaces the fallback time they were indexed with.
+        updated = {entry[4] for entry in new_entries}
+        entries = sorted(
+            [entry for entry in self._entries if entry[4] not in updated] + new_entries,
+            reverse=True,
+        )
+        if entries == self._entries:
+            return False
+        self._entries = entries
+        self._build()
+        return True
+
+    def runinfo(self):
+        return self._runinfo
+
+    def _build(self):
+        cards = [
+            {"label": "%s/%s %s" % (step, task_id, name), "card": card_id}
+            for _, step, task_id, name, card_id in self._entries
+        ]
+        by_step = {}
+        for i, entry in enumerate(self._entries):
+            by_step.setdefault(entry[1], []).append(i)
+        # Replaced as a whole so that queries never mix two versions.
+        self._state = (self._entries, cards, by_step, LRUCache(RUN_VIEW_CACHE_SIZE))
+        self._runinfo = {
+            "status": "ok",
+            "flow": self.flow,
+            "run_id": self.run_id,
+            "cards": cards,
+        }
+
+    def query(
+        self,
+        step=None,
+        card_type=None,
+        name=None,
+        task_from=None,
+        task_to=None,
+        sort="time",
+        page=1,
+        page_size=PAGE_SIZE,
+    ):
+        entries, cards, by_step, views = self._state
+        task_range = task_from is not None or task_to is not None
+        key = (step, card_type, name, "task" if task_range else sort)
+        view = views.get(key)
+        if view is None:
+            view = self._view(entries, by_step, *key)
+            views.put(key, view)
+        rows, task_keys = view
+        if task_range:
+            lo = bisect.bisect_left(task_keys, _task_key(task_from)) if task_from else 0
+            hi = (
+                bisect.bisect_right(task_keys, _task_key(task_to))
+                if task_to
+                else len(rows)
+            )
+            rows = rows[lo:hi]
+            if sort == "time":
+                # Rows are positions in the time ordered entries.
+                rows = sorted(rows)
+        start = (page - 1) * page_size
+        return {
+            "status": "ok",
+            "flow": self.flow,
+            "run_id": self.run_id,
+            "steps": {name: len(positions) for name, positions in by_step.items()},
+            "total": len(rows),
+            "page": page,
+            "page_size": page_size,
+            "cards": [cards[i] for i in rows[start : start + page_size]],
+        }
+
+    def _view(self, entries, by_step, step, card_type, name, sort):
+        if step is None:
+            rows = range(len(entries))
         else:
-            self.wfile.write(body)            
+            rows = by_step.get(step, [])
+        rows = [
+            i
+            for i in rows
+            if (name is None or entries[i][3] == name)
+            and (card_type is None or _card_type(entries[i][4]) == card_type)
+        ]
+        if sort != "task":
+            return rows, None
+        rows.sort(key=lambda i: _task_key(entries[i][2]))
+        return rows, [_task_key(entries[i][2]) for i in rows]
+
+
+class CardIndex(object):
+    """
+    Keeps a `RunIndex` of the latest run up to date from a background thread.
+    Other runs are indexed when they are asked for and the most recently used
+    ones are kept.
+
+    Background scans back off while they find nothing new, which is what
+    happens once a run finished, and further when nobody asks for the run.
+    """
+
+    def __init__(self, interval=INDEX_REFRESH_INTERVAL):
+        self.interval = interval
+        self._run = None
+        self._runs = LRUCache(RUN_INDEX_CACHE_SIZE)
+        self._lock = threading.Lock()
+        self._ready = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._loop, daemon=True)
+            self._thread.start()
+
+    def _loop(self):
+        while True:
+            try:
+                self.refresh()
+            except Exception as ex:
+                print("Refreshing the card index failed: %s" % ex)
+            self._ready.set()
+            time.sleep(self.interval)
+
+    def refresh(self):
+        RUN_CATALOG.refresh()
+        latest = RUN_CATALOG.latest()
+        if latest is None:
+            self._run = None
+            return
+        run = self.run(*latest)
+        self._run = run
+        now = time.time()
+        if now - run.updated >= run.backoff:
+            watched = now - run.last_access < INDEX_IDLE_TIMEOUT
+            limit = INDEX_WATCHED_MAX_INTERVAL if watched else INDEX_MAX_INTERVAL
+            if run.update():
+                run.backoff = 0
+            else:
+                run.backoff = min(max(run.backoff * 2, self.interval), limit)
+        self._ready.set()
+
+    def run(self, flow, run_id):
+        key = (flow, run_id)
+        run = self._run
+        if run is not None and (run.flow, run.run_id) == key:
+            return run
+        with self._lock:
+            run = self._runs.get(key)
+            if run is None:
+                run = RunIndex(flow, run_id)
+                self._runs.put(key, run)
+        return run
+
+    def run_index(self, flow=None, run_id=None):
+        # The up to date index of a run, by default of the latest one.
+        if flow is not None:
+            run = self.run(flow, run_id)
+            run.update(max_age=self.interval)
+        else:
+            self._ready.wait(INDEX_READY_TIMEOUT)
+            run = self._run
+        if run is not None:
+            if time.time() - run.last_access >= INDEX_IDLE_TIMEOUT:
+                # Somebody is looking again, scan at full rate.
+                run.backoff = 0
+            run.last_access = time.time()
+        return run
+
+    def runinfo(self, flow=None, run_id=None):
+        run = self.run_index(flow, run_id)
+        if run is None:
+            return {"status": "no runs"}
+        return run.runinfo()
+
+
+def _equal(old, new):
+    # Unlike ==, tells 1 from 1.0 and True, at any depth: JSON clients do.
+    if type(old) is not type(new):
+        return False
+    if isinstance(old, dict):
+        return old.keys() == new.keys() and all(_equal(old[k], new[k]) for k in old)
+    if isinstance(old, list):
+        return len(old) == len(new) and all(map(_equal, old, new))
+    return old == new
+
+
+def diff_payload(old, new, path=()):
+    """
+    Returns the list of operations that turn `old` into `new`.
+
+    Operations are dicts with an `op` (`set`, `append` or `remove`) and a
+    `path` of keys/indices from the root of the payload. Lists that only grew
+    at the end, like chart values, produce a single `append`.
+    """
+    if isinstance(old, dict) and isinstance(new, dict):
+        ops = [{"op": "remove", "path": list(path) + [k]} for k in old if k not in new]
+        for key, value in new.items():
+            if key in old:
+                ops.extend(diff_payload(old[key], value, path + (key,)))
+            else:
+                ops.append({"op": "set", "path": list(path) + [key], "value": value})
+        return ops
+    if isinstance(old, list) and isinstance(new, list) and len(new) >= len(old):
+        changed = [i for i, value in enumerate(old) if not _equal(value, new[i])]
+        if len(changed) <= len(old) // 2:
+            ops = [
+                {"op": "set", "path": list(path) + [i], "value": new[i]}
+                for i in changed
+            ]
+            if len(new) > len(old):
+                ops.append(
+                    {"op": "append", "path": list(path), "values": new[len(old) :]}
+                )
+            return ops
+    if _equal(old, new):
+        return []
+    return [{"op": "set", "path": list(path), "value": new}]
+
+
+def apply_delta(payload, delta):
+    """
+    Applies the operations produced by `diff_payload` to `payload` and returns
+    the result. This is what a client does with a `delta` response.
+    """
+    for op in delta:
+        path = op["path"]
+        if op["op"] == "append":
+            target = payload
+            for key in path:
+                target = target[key]
+            target.extend(op["values"])
+            continue
+        if not path:
+            payload = op["value"]
+            continue
+        parent = payload
+        for key in path[:-1]:
+            parent = parent[key]
+        if op["op"] == "set":
+            parent[path[-1]] = op["value"]
+        else:
+            del parent[path[-1]]
+    return payload
+
+
+class DataFeed(object):
+    """
+    Versioned view of one runtime data object, shared by every request and
+    subscriber of that card.
+
+    Each time the object changes, the feed gets a new version and records the
+    delta from the previous one, so that a client that already holds version
+    `since` only receives what changed. While the feed has subscribers, a
+    single watcher thread polls the object; it only looks at the object's
+    metadata on each tick and downloads it when its size or modification time
+    changed.
+    """
+
+    def __init__(self, url, interval=WATCH_INTERVAL):
+        self.url = url
+        self.interval = interval
+        # Versions are "<epoch>-<sequence>" so that a version handed out by a
+        # previous viewer process is never mistaken for a current one.
+        self.epoch = "%x" % int(time.time() * 1000)
+        self.version = None
+        self.payload = None
+        self.subscribers = set()
+        self.last_access = time.time()
+        self._seq = 0
+        self._history = deque(maxlen=DELTA_HISTORY)
+        self._stamp = None
+        self._blob = None
+        self._last_poll = 0
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def subscribe(self, events):
+        with self._lock:
+            self.subscribers.add(events)
+            if self.version is not None:
+                events.put(self.version)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._watch, daemon=True)
+                self._thread.start()
+
+    def unsubscribe(self, events):
+        with self._lock:
+            self.subscribers.discard(events)
+        self.last_access = time.time()
+
+    def _watch(self):
+        while True:
+            with self._lock:
+                if not self.subscribers:
+                    self._thread = None
+                    return
+            try:
+                self.refresh()
+            except Exception as ex:
+                print("Watching %s failed: %s" % (self.url, ex))
+            time.sleep(self.interval)
+
+    def refresh(self, max_age=0):
+        # The watcher and any number of /data requests may ask at once; they
+        # all share a single fetch.
+        if time.time() - self._last_poll < max_age:
+            return
+        FLIGHTS.do(("data", self.url), self._refresh)
+
+    def _refresh(self):
+        self._last_poll = time.time()
+        blob = self._fetch()
+        if blob is not None:
+            self._publish(json.loads(blob))
+
+    def _fetch(self):
+        # Returns the blob if it changed since the previous fetch, else None.
+        with METRICS.timer("datastore_info"):
+            info = DATASTORE.info(self.url)
+        if info is None:
+            return None
+        stamp = (info.size, info.last_modified)
+        if stamp == self._stamp:
+            return None
+        with METRICS.timer("datastore_get"):
+            blob = DATASTORE.get(self.url)
+        if blob is None:
+            return None
+        self._stamp = stamp
+        if blob == self._blob:
+            return None
+        self._blob = blob
+        return blob
+
+    def _publish(self, payload):
+        with self._lock:
+            previous = self.version
+            self._seq += 1
+            self.version = "%s-%d" % (self.epoch, self._seq)
+            if previous is not None:
+                delta = diff_payload(self.payload, payload)
+                self._history.append((previous, self.version, delta))
+            self.payload = payload
+            for events in self.subscribers:
+                events.put(self.version)
+
+    def message(self, since=None):
+        """
+        Response body for a client holding version `since`: a `delta` when
+        the history still reaches back to `since`, the full `payload` otherwise.
+        """
+        self.last_access = time.time()
+        with self._lock:
+            if self.version is None:
+                return {"status": "not found"}
+            body = {"status": "ok", "version": self.version}
+            if since == self.version:
+                body.update(since=since, delta=[])
+                return body
+            delta = None
+            for base, version, ops in self._history:
+                if delta is not None:
+                    delta.extend(ops)
+                elif base == since:
+                    delta = list(ops)
+            if delta is None:
+                body["payload"] = self.payload
+            else:
+                body.update(since=since, delta=delta)
+            return body
+
+
+def stream_event(feed, since):
+    """
+    Returns the new version and the Server-Sent Event to send to a client
+    holding version `since`, or `(since, None)` if there is nothing to send.
+    """
+    body = feed.message(since)
+    if "version" not in body or body.get("delta") == []:
+        return since, None
+    since = body["version"]
+    return since, ("id: %s\ndata: %s\n\n" % (since, json.dumps(body))).encode("utf-8")
+
+
+class DataFeedRegistry(object):
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._feeds = {}
+        self._last_prune = time.time()
 
-    ROUTES = {"runinfo": get_runinfo, "card": get_card, "data": get_data}
+    def get(self, url):
+        with self._lock:
+            self._prune()
+            feed = self._feeds.get(url)
+            if feed is None:
+                feed = self._feeds[url] = DataFeed(url)
+            feed.last_access = time.time()
+            return feed
 
+    def subscribe(self, url, events):
+        # `events` only needs a `put` method; it receives the new version
+        # each time the feed changes.
+        feed = self.get(url)
+        feed.subscribe(events)
+        return feed
 
-def find_latest_run():
-    def _list():
-        for flow in os.listdir(".metaflow"):
-            path = os.path.join(".metaflow", flow, "latest_run")
-            if os.path.exists(path):
-                with open(path) as f:
-                    yield flow, f.read()
+    def unsubscribe(self, feed, events):
+        feed.unsubscribe(events)
 
-    for flow, run_id in sorted(_list(), reverse=True):
-        return flow, run_id
+    def _prune(self):
+        now = time.time()
+        if now - self._last_prune < FEED_IDLE_TIMEOUT:
+            return
+        self._last_prune = now
+        for url, feed in list(self._feeds.items()):
+            if not feed.subscribers and now - feed.last_access > FEED_IDLE_TIMEOUT:
+                del self._feeds[url]
 
 
-def task_time(pathspec):
-    if pathspec not in TASK_CACHE:
-        TASK_CACHE[pathspec] = Task(pathspec).created_at
-    return TASK_CACHE[pathspec]
+RUN_CATALOG = RunCatalog()
+CARD_INDEX = CardIndex()
+DATA_FEEDS = DataFeedRegistry()
+BLOB_CACHE = BlobCache()
+METRICS = Metrics()
+TASK_CACHE = LRUCache(TASK_CACHE_SIZE)
+FINISHED_TASKS = LRUCache(TASK_CACHE_SIZE)
+FLIGHTS = SingleFlight()
 
 
-def find_cards(flow, run_id):
-    root = os.path.join(metaflow_config.CARD_S3ROOT, flow, "runs", run_id, "")
-    with S3() as s3:
-        objs = s3.list_recursive([root])
-        for obj in objs:
-            print(obj.key)
-            if obj.key.startswith("steps/") and obj.key.endswith('.html') and obj.size > 0:
-                _, step, _, task_id, _, fname = obj.key.split("/")
-                name = fname.split("-")[-2]
-                pathspec = f"{flow}/{run_id}/{step}/{task_id}"
-                card_id = "%s/%s" % (pathspec, fname.split(".")[0])
-                yield task_time(pathspec), step, task_id, name, card_id
+DATASTORE = make_datastore("s3")
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Real-time card viewer")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--datastore", choices=("s3", "local"), default="s3")
+    parser.add_argument(
+        "--server",
+        choices=("threading", "asyncio"),
+        default="threading",
+        help="asyncio serves many concurrent viewers and streams without a "
+        "thread per connection",
+    )
+    parser.add_argument(
+        "--max-concurrency",
+        type=int,
+        default=ASYNC_MAX_CONCURRENCY,
+        help="Requests the asyncio server processes at once",
+    )
+    parser.add_argument(
+        "--pool-size",
+        type=int,
+        default=DATASTORE_POOL_SIZE,
+        help="Number of datastore clients shared by the server threads",
+    )
+    args = parser.parse_args()
+    DATASTORE = make_datastore(args.datastore, pool_size=args.pool_size)
     namespace(None)
-    server_address = ("", 8000)
-    httpd = ThreadingHTTPServer(server_address, RequestHandler)
+    CARD_INDEX.start()
+    if args.server == "asyncio":
+        httpd = AsyncCardServer("", args.port, max_concurrency=args.max_concurrency)
+    else:
+        server_address = ("", args.port)
+        httpd = ThreadingHTTPServer(server_address, RequestHandler)
     httpd.serve_forever()
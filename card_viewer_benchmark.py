@@ -0,0 +1,368 @@
+"""
+Load test for `card_viewer.py` against a synthetic local datastore.
+
+Generates a run with N steps x M tasks x K cards in the layout of
+`--datastore local`, starts the viewer on it and drives concurrent `/runinfo`,
+`/card` and `/data` clients, then reports throughput, tail latency and the
+viewer's memory.
+
+    python card_viewer_benchmark.py --steps 4 --tasks 500 --cards 2 \\
+        --runinfo-clients 4 --card-clients 16 --data-clients 32 --duration 30
+"""
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import tempfile
+import threading
+import zlib
+import subprocess
+import http.client
+
+ABS_DIR_PATH = os.path.dirname(os.path.abspath(__file__))
+VIEWER_PATH = os.path.join(ABS_DIR_PATH, "card_viewer.py")
+
+FLOW_NAME = "BenchmarkFlow"
+RUN_ID = "1"
+
+
+def card_html(card_size):
+    return ("<html><body>%s</body></html>" % ("x" * card_size)).encode("utf-8")
+
+
+def generate_run(root, steps, tasks, cards, card_size, data_points):
+    """
+    Writes the `.metaflow` tree of one run under `root` and returns the list
+    of card ids ("flow/run/step/task/card") it contains.
+    """
+    flow_dir = os.path.join(root, ".metaflow", FLOW_NAME)
+    os.makedirs(flow_dir, exist_ok=True)
+    with open(os.path.join(flow_dir, "latest_run"), "w") as f:
+        f.write(RUN_ID)
+    run_root = os.path.join(root, ".metaflow", "mf.cards", FLOW_NAME, "runs", RUN_ID)
+    html = card_html(card_size)
+    data = json.dumps(
+        {"values": [{"step": i, "loss": 1.0 / (i + 1)} for i in range(data_points)]}
+    ).encode("utf-8")
+    card_ids = []
+    task_id = 0
+    for step in range(steps):
+        step_name = "step%d" % step
+        for _ in range(tasks):
+            task_id += 1
+            task_root = os.path.join(run_root, "steps", step_name, "tasks", str(task_id))
+            os.makedirs(os.path.join(task_root, "cards"), exist_ok=True)
+            os.makedirs(os.path.join(task_root, "runtime"), exist_ok=True)
+            for card in range(cards):
+                fname = "blank-card%d-%08x" % (card, random.getrandbits(32))
+                with open(os.path.join(task_root, "cards", fname + ".html"), "wb") as f:
+                    f.write(html)
+                with open(
+                    os.path.join(task_root, "runtime", fname + ".data.json"), "wb"
+                ) as f:
+                    f.write(data)
+                card_ids.append(
+                    "%s/%s/%s/%d/%s" % (FLOW_NAME, RUN_ID, step_name, task_id, fname)
+                )
+    return card_ids
+
+
+def data_path(root, card_id):
+    flow, run_id, step, task_id, fname = card_id.split("/")
+    return os.path.join(
+        root, ".metaflow", "mf.cards", flow, "runs", run_id, "steps", step,
+        "tasks", task_id, "runtime", fname + ".data.json",
+    )
+
+
+def update_data(root, card_ids, interval, stop):
+    # Simulates running tasks appending points to their runtime data.
+    while not stop.wait(interval):
+        path = data_path(root, random.choice(card_ids))
+        with open(path) as f:
+            data = json.load(f)
+        data["values"].append({"step": len(data["values"]), "loss": random.random()})
+        tmp = path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(data, f)
+        os.rename(tmp, path)
+
+
+def start_viewer(root, port, server):
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join(
+        p for p in (ABS_DIR_PATH, env.get("PYTHONPATH")) if p
+    )
+    env.setdefault("METAFLOW_DEFAULT_METADATA", "local")
+    env.setdefault("METAFLOW_DEFAULT_DATASTORE", "local")
+    proc = subprocess.Popen(
+        [
+            sys.executable,
+            VIEWER_PATH,
+            "--datastore",
+            "local",
+            "--port",
+            str(port),
+            "--server",
+            server,
+        ],
+        cwd=root,
+        env=env,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    deadline = time.time() + 60
+    while time.time() < deadline:
+        if proc.poll() is not None:
+            raise RuntimeError("The viewer exited with code %d" % proc.returncode)
+        try:
+            conn = http.client.HTTPConnection("127.0.0.1", port, timeout=5)
+            conn.request("GET", "/metrics")
+            conn.getresponse().read()
+            return proc
+        except OSError:
+            time.sleep(0.2)
+    proc.kill()
+    raise RuntimeError("The viewer did not start within 60 seconds")
+
+
+def check_runinfo(port, card_ids, timeout=60):
+    # The viewer must list every card of the generated run before the load.
+    deadline = time.time() + timeout
+    while True:
+        conn = http.client.HTTPConnection("127.0.0.1", port, timeout=30)
+        conn.request("GET", "/runinfo")
+        listed = {card["card"] for card in json.loads(conn.getresponse().read())["cards"]}
+        conn.close()
+        if listed == set(card_ids):
+            return
+        if time.time() > deadline:
+            raise RuntimeError(
+                "/runinfo lists %d cards, the run has %d" % (len(listed), len(card_ids))
+            )
+        time.sleep(0.5)
+
+
+def memory(pid):
+    # Current and peak resident memory (MB) of a process, from /proc.
+    usage = {}
+    try:
+        with open("/proc/%d/status" % pid) as f:
+            for line in f:
+                key, _, value = line.partition(":")
+                if key in ("VmRSS", "VmHWM"):
+                    usage[key] = int(value.split()[0]) / 1024.0
+    except OSError:
+        pass
+    return usage.get("VmRSS"), usage.get("VmHWM")
+
+
+class Client(threading.Thread):
+    """
+    One viewer client issuing requests to `route` on a keep-alive connection
+    until `deadline`, recording the latency of every request. Responses that
+    are not what the generated run holds count as errors.
+    """
+
+    def __init__(self, port, route, card_ids, deadline, card_size):
+        super().__init__(daemon=True)
+        self.port = port
+        self.route = route
+        self.card_ids = card_ids
+        self.deadline = deadline
+        self.card_length = len(card_html(card_size))
+        self.latencies = []
+        self.errors = 0
+        self.bytes = 0
+
+    def _path(self):
+        if self.route == "runinfo":
+            return "/runinfo"
+        return "/%s/%s" % (self.route, random.choice(self.card_ids))
+
+    def _valid(self, resp, body):
+        if resp.status != 200:
+            return False
+        try:
+            encoding = resp.getheader("Content-Encoding")
+            if encoding:
+                body = zlib.decompress(body, 31 if encoding == "gzip" else 15)
+            if self.route == "card":
+                return len(body) == self.card_length
+            body = json.loads(body)
+            if self.route == "runinfo":
+                return len(body["cards"]) == len(self.card_ids)
+            return body["status"] == "ok" and "values" in body["payload"]
+        except (zlib.error, ValueError, KeyError, TypeError):
+            return False
+
+    def run(self):
+        conn = http.client.HTTPConnection("127.0.0.1", self.port, timeout=30)
+        headers = {"Accept-Encoding": "gzip"}
+        while time.time() < self.deadline:
+            start = time.perf_counter()
+            try:
+                conn.request("GET", self._path(), headers=headers)
+                resp = conn.getresponse()
+                body = resp.read()
+                self.bytes += len(body)
+                if not self._valid(resp, body):
+                    self.errors += 1
+            except (OSError, http.client.HTTPException):
+                self.errors += 1
+                conn.close()
+                conn = http.client.HTTPConnection("127.0.0.1", self.port, timeout=30)
+                continue
+            self.latencies.append(time.perf_counter() - start)
+        conn.close()
+
+
+def percentile(values, q):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def run_benchmark(args):
+    root = args.workdir or tempfile.mkdtemp(prefix="card-viewer-bench-")
+    try:
+        start = time.time()
+        card_ids = generate_run(
+            root, args.steps, args.tasks, args.cards, args.card_size, args.data_points
+        )
+        print(
+            "Generated %d cards in %.1fs under %s"
+            % (len(card_ids), time.time() - start, root)
+        )
+        proc = start_viewer(root, args.port, args.server)
+        stop = threading.Event()
+        try:
+            check_runinfo(args.port, card_ids)
+            if args.update_interval > 0:
+                threading.Thread(
+                    target=update_data,
+                    args=(root, card_ids, args.update_interval, stop),
+                    daemon=True,
+                ).start()
+            deadline = time.time() + args.duration
+            clients = (
+                [Client(args.port, "runinfo", card_ids, deadline, args.card_size) for _ in range(args.runinfo_clients)]
+                + [Client(args.port, "card", card_ids, deadline, args.card_size) for _ in range(args.card_clients)]
+                + [Client(args.port, "data", card_ids, deadline, args.card_size) for _ in range(args.data_clients)]
+            )
+            rss_samples = []
+            for client in clients:
+                client.start()
+            while any(client.is_alive() for client in clients):
+                rss_samples.append(memory(proc.pid)[0] or 0.0)
+                time.sleep(0.5)
+            rss, peak = memory(proc.pid)
+            conn = http.client.HTTPConnection("127.0.0.1", args.port, timeout=30)
+            conn.request("GET", "/metrics")
+            server_metrics = json.loads(conn.getresponse().read())
+        finally:
+            stop.set()
+            proc.terminate()
+            proc.wait()
+        report = {
+            "server": args.server,
+            "cards": len(card_ids),
+            "duration": args.duration,
+            "routes": {},
+            "memory_mb": {
+                "rss": rss,
+                "peak": peak,
+                "mean_rss_under_load": sum(rss_samples) / len(rss_samples)
+                if rss_samples
+                else None,
+            },
+            "server_operations": server_metrics.get("operations", {}),
+        }
+        for route in ("runinfo", "card", "data"):
+            route_clients = [c for c in clients if c.route == route]
+            if not route_clients:
+                continue
+            latencies = [l for c in route_clients for l in c.latencies]
+            report["routes"][route] = {
+                "clients": len(route_clients),
+                "requests": len(latencies),
+                "errors": sum(c.errors for c in route_clients),
+                "throughput": len(latencies) / args.duration,
+                "bytes": sum(c.bytes for c in route_clients),
+                "p50_ms": percentile(latencies, 0.5) * 1000,
+                "p95_ms": percentile(latencies, 0.95) * 1000,
+                "p99_ms": percentile(latencies, 0.99) * 1000,
+                "max_ms": max(latencies) * 1000 if latencies else 0.0,
+            }
+        return report
+    finally:
+        if not args.workdir and not args.keep:
+            shutil.rmtree(root, ignore_errors=True)
+
+
+def print_report(report):
+    print(
+        "\n%s server, %d cards, %ds"
+        % (report["server"], report["cards"], report["duration"])
+    )
+    print(
+        "%-8s %7s %9s %7s %10s %9s %9s %9s %9s"
+        % ("route", "clients", "requests", "errors", "req/s", "p50 ms", "p95 ms", "p99 ms", "max ms")
+    )
+    for route, stats in report["routes"].items():
+        print(
+            "%-8s %7d %9d %7d %10.1f %9.2f %9.2f %9.2f %9.2f"
+            % (
+                route,
+                stats["clients"],
+                stats["requests"],
+                stats["errors"],
+                stats["throughput"],
+                stats["p50_ms"],
+                stats["p95_ms"],
+                stats["p99_ms"],
+                stats["max_ms"],
+            )
+        )
+    mem = report["memory_mb"]
+    print(
+        "viewer memory: rss %s MB, peak %s MB"
+        % (
+            "%.1f" % mem["rss"] if mem["rss"] is not None else "n/a",
+            "%.1f" % mem["peak"] if mem["peak"] is not None else "n/a",
+        )
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Card viewer load test")
+    parser.add_argument("--steps", type=int, default=2)
+    parser.add_argument("--tasks", type=int, default=100, help="Tasks per step")
+    parser.add_argument("--cards", type=int, default=1, help="Cards per task")
+    parser.add_argument("--card-size", type=int, default=200 * 1024, help="Bytes")
+    parser.add_argument("--data-points", type=int, default=1000)
+    parser.add_argument("--runinfo-clients", type=int, default=2)
+    parser.add_argument("--card-clients", type=int, default=8)
+    parser.add_argument("--data-clients", type=int, default=8)
+    parser.add_argument("--duration", type=int, default=20, help="Seconds")
+    parser.add_argument(
+        "--update-interval",
+        type=float,
+        default=0.1,
+        help="Seconds between two runtime data updates; 0 disables them",
+    )
+    parser.add_argument("--server", choices=("threading", "asyncio"), default="threading")
+    parser.add_argument("--port", type=int, default=8399)
+    parser.add_argument("--workdir", default=None, help="Reuse this directory")
+    parser.add_argument("--keep", action="store_true", help="Keep the generated run")
+    parser.add_argument("--json", default=None, help="Also write the report here")
+    args = parser.parse_args()
+    report = run_benchmark(args)
+    print_report(report)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
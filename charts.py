@@ -6,6 +6,129 @@ except ImportError:
     pd = None
 import numpy as np
 
+# Points a chart series sends to the browser at most.
+DEFAULT_MAX_POINTS = 1000
+
+# Most recent points of a series that are always kept at full resolution.
+DEFAULT_RECENT_POINTS = 200
+
+
+def _number(value):
+    return value if isinstance(value, (int, float)) else None
+
+
+def _buckets(points, count):
+    # Splits x-ordered points into `count` buckets of equal x range, dropping
+    # the empty ones. Equal x ranges (rather than equal numbers of points)
+    # keep the density even across repeated downsampling.
+    x0, x1 = points[0][0], points[-1][0]
+    width = (x1 - x0) / count or 1
+    buckets = [[] for _ in range(count)]
+    for point in points:
+        buckets[min(int((point[0] - x0) / width), count - 1)].append(point)
+    return [bucket for bucket in buckets if bucket]
+
+
+def lttb(points, threshold):
+    """
+    Largest-Triangle-Three-Buckets downsampling of x-ordered `(x, y, datum)`
+    points to at most `threshold` points, keeping the first and the last one.
+    """
+    if threshold >= len(points) or threshold < 3:
+        return list(points)
+    buckets = _buckets(points[1:-1], threshold - 2) + [points[-1:]]
+    sampled = [points[0]]
+    for bucket, next_bucket in zip(buckets, buckets[1:]):
+        # Average of the next bucket, the third vertex of the triangles.
+        avg_x = sum(p[0] for p in next_bucket) / len(next_bucket)
+        avg_y = sum(p[1] for p in next_bucket) / len(next_bucket)
+        ax, ay = sampled[-1][0], sampled[-1][1]
+        sampled.append(
+            max(
+                bucket,
+                key=lambda p: abs((ax - avg_x) * (p[1] - ay) - (ax - p[0]) * (avg_y - ay)),
+            )
+        )
+    sampled.append(points[-1])
+    return sampled
+
+
+def minmax(points, threshold):
+    """
+    Min/max decimation of x-ordered `(x, y, datum)` points to at most
+    `threshold` points: the lowest and the highest point of each bucket, so
+    isolated spikes are never lost.
+    """
+    if threshold >= len(points) or threshold < 2:
+        return list(points)
+    sampled = []
+    for bucket in _buckets(points, threshold // 2):
+        low = min(range(len(bucket)), key=lambda j: bucket[j][1])
+        high = max(range(len(bucket)), key=lambda j: bucket[j][1])
+        sampled.extend(bucket[j] for j in sorted({low, high}))
+    return sampled
+
+
+DOWNSAMPLERS = {"lttb": lttb, "minmax": minmax}
+
+# Fewest points each downsampler reduces to; asked for less, it keeps all.
+MIN_DOWNSAMPLED = {"lttb": 3, "minmax": 2}
+
+
+class SeriesStore:
+    """
+    Points of a chart series with a bounded size: the `recent_points` latest
+    ones at full resolution, the older ones downsampled (`"lttb"`, which
+    keeps the shape, or `"minmax"`, which keeps every extreme) so that the
+    series never holds more than `max_points`.
+
+    Older points are compacted to 3/4 of their share whenever they exceed it,
+    so downsampling runs once every many appends. Points whose x is not a
+    number (timestamps) are placed by their order of arrival.
+    """
+
+    def __init__(
+        self,
+        x_name,
+        y_name,
+        max_points=DEFAULT_MAX_POINTS,
+        recent_points=DEFAULT_RECENT_POINTS,
+        downsample="lttb",
+    ):
+        self.x_name = x_name
+        self.y_name = y_name
+        self.max_points = max_points
+        self._downsample = DOWNSAMPLERS[downsample]
+        self._min_points = MIN_DOWNSAMPLED[downsample]
+        # Leaves the history room for at least the downsampler's minimum.
+        self.recent_points = max(
+            0, min(recent_points, max_points // 2, max_points - self._min_points)
+        )
+        self._history = []
+        self._recent = []
+        self._count = 0
+
+    def append(self, datum):
+        x = _number(datum.get(self.x_name))
+        y = _number(datum.get(self.y_name))
+        self._recent.append((self._count if x is None else x, y or 0, datum))
+        self._count += 1
+        if len(self._recent) > self.recent_points:
+            overflow = len(self._recent) - self.recent_points
+            self._history.extend(self._recent[:overflow])
+            del self._recent[:overflow]
+            share = self.max_points - self.recent_points
+            if len(self._history) > share:
+                target = max(share * 3 // 4, self._min_points)
+                self._history = self._downsample(self._history, target)
+
+    def values(self):
+        return [point[2] for point in self._history] + [point[2] for point in self._recent]
+
+    def __len__(self):
+        return len(self._history) + len(self._recent)
+
+
 def update_spec_data(spec, data):
     spec["data"]["values"].append(data)
     return spec
@@ -117,6 +240,48 @@ def line_chart_spec(
     return spec, data
 
 
+def flame_graph_spec(title=None):
+    # Rows are the rectangles of `StackSampler.rows`, the root at the bottom.
+    y = {"field": "depth", "type": "ordinal", "axis": None, "sort": "descending"}
+    return {
+        "title": title if title else "Flame Graph",
+        "$schema": "https://vega.github.io/schema/vega-lite/v5.json",
+        "data": {"name": "values", "values": []},
+        "height": {"step": 18},
+        "layer": [
+            {
+                "mark": {"type": "rect", "stroke": "white", "strokeWidth": 0.5},
+                "encoding": {
+                    "x": {"field": "x0", "type": "quantitative", "axis": None},
+                    "x2": {"field": "x1"},
+                    "y": y,
+                    "color": {
+                        "field": "name",
+                        "type": "nominal",
+                        "legend": None,
+                        "scale": {"scheme": "oranges"},
+                    },
+                    "tooltip": [
+                        {"field": "name", "type": "nominal", "title": "frame"},
+                        {"field": "value", "type": "quantitative", "title": "samples"},
+                        {"field": "share", "type": "quantitative", "format": ".1%"},
+                    ],
+                },
+            },
+            {
+                # Only label frames wide enough to show some text.
+                "transform": [{"filter": "datum.share > 0.04"}],
+                "mark": {"type": "text", "align": "left", "dx": 3, "fontSize": 10},
+                "encoding": {
+                    "x": {"field": "x0", "type": "quantitative"},
+                    "y": y,
+                    "text": {"field": "name"},
+                },
+            },
+        ],
+    }
+
+
 def altair_line_chart_spec():
     import altair as alt
     import numpy as np
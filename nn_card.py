@@ -1,4 +1,10 @@
-from charts import line_chart_spec, update_spec_data
+from charts import (
+    line_chart_spec,
+    flame_graph_spec,
+    SeriesStore,
+    DEFAULT_MAX_POINTS,
+    DEFAULT_RECENT_POINTS,
+)
 from metaflow import current
 from metaflow.cards import (
     VegaChart,
@@ -13,12 +19,31 @@ from keras import callbacks  # pylint: disable=import-error
 
 
 class LineChart(MetaflowCardComponent):
+    """
+    Keeps at most `max_points` points, the latest `recent_points` of them at
+    full resolution and the older ones downsampled, so the size of a refresh
+    does not grow with the length of the step.
+    """
+
     REALTIME_UPDATABLE = True
 
     def __init__(
-        self, title, xtitle, ytitle, x_name, y_name, width, height, with_params=False, x_axis_temporal=False
+        self,
+        title,
+        xtitle,
+        ytitle,
+        x_name,
+        y_name,
+        width,
+        height,
+        with_params=False,
+        x_axis_temporal=False,
+        max_points=DEFAULT_MAX_POINTS,
+        recent_points=DEFAULT_RECENT_POINTS,
+        downsample="lttb",
     ):
         super().__init__()
+        self.series = SeriesStore(x_name, y_name, max_points, recent_points, downsample)
 
         self.spec, _ = line_chart_spec(
             title=title,
@@ -33,10 +58,30 @@ class LineChart(MetaflowCardComponent):
         )
 
     def update(self, data):  # Can take a diff
-        self.spec = update_spec_data(self.spec, data)
+        self.series.append(data)
+
+    @with_default_component_id
+    def render(self):
+        self.spec["data"]["values"] = self.series.values()
+        vega_chart = VegaChart(self.spec,)
+        vega_chart.component_id = self.component_id
+        return vega_chart.render()
+
+
+class FlameGraph(MetaflowCardComponent):
+    REALTIME_UPDATABLE = True
+
+    def __init__(self, title=None):
+        super().__init__()
+        self.spec = flame_graph_spec(title=title)
+        self.rows = []
+
+    def update(self, rows):
+        self.rows = rows
 
     @with_default_component_id
     def render(self):
+        self.spec["data"]["values"] = self.rows
         vega_chart = VegaChart(self.spec,)
         vega_chart.component_id = self.component_id
         return vega_chart.render()
@@ -0,0 +1,84 @@
+"""
+Full-resolution profiler samples as typed columns, and their binary format.
+
+Layout (little-endian):
+    magic (8 bytes), number of columns (uint32), number of rows (uint64)
+    column names, each as a uint16 length and UTF-8 bytes
+    zero padding to a multiple of 8 bytes
+    the "time" column as float64, then every other column as float32
+"""
+import sys
+import struct
+from array import array
+
+MAGIC = b"MFPROF\x01\x00"
+
+_HEADER = struct.Struct("<8sIQ")
+_NAME_LENGTH = struct.Struct("<H")
+
+
+class SampleColumns:
+    """
+    Samples of the profiler, one typed array per field: seconds since the
+    epoch as float64 (float32 would round them to minutes), metrics as float32.
+    """
+
+    def __init__(self, fields):
+        self.fields = tuple(fields)
+        self.columns = {
+            name: array("d" if name == "time" else "f") for name in self.fields
+        }
+        self._ordered = [self.columns[name] for name in self.fields]
+
+    def append(self, sample):
+        for column, value in zip(self._ordered, sample):
+            column.append(value)
+
+    def __len__(self):
+        return len(self.columns[self.fields[0]]) if self.fields else 0
+
+    def to_bytes(self):
+        names = ["time"] + [name for name in self.fields if name != "time"]
+        parts = [_HEADER.pack(MAGIC, len(names), len(self))]
+        for name in names:
+            encoded = name.encode("utf-8")
+            parts.append(_NAME_LENGTH.pack(len(encoded)) + encoded)
+        size = sum(len(part) for part in parts)
+        parts.append(b"\0" * (-size % 8))
+        for name in names:
+            column = self.columns.get(name, array("d"))
+            if sys.byteorder == "big":
+                column = array(column.typecode, column)
+                column.byteswap()
+            parts.append(column.tobytes())
+        return b"".join(parts)
+
+
+def load_samples(data):
+    """
+    Reads what `SampleColumns.to_bytes` wrote (e.g. the `profiler_samples`
+    artifact of a task) back into a dict of column name -> `array`, with the
+    columns copied straight from the buffer.
+    """
+    view = memoryview(data)
+    magic, count, rows = _HEADER.unpack_from(view, 0)
+    if magic != MAGIC:
+        raise ValueError("Not a profiler samples artifact")
+    offset = _HEADER.size
+    names = []
+    for _ in range(count):
+        (length,) = _NAME_LENGTH.unpack_from(view, offset)
+        offset += _NAME_LENGTH.size
+        names.append(bytes(view[offset : offset + length]).decode("utf-8"))
+        offset += length
+    offset += -offset % 8
+    columns = {}
+    for name in names:
+        column = array("d" if name == "time" else "f")
+        size = rows * column.itemsize
+        column.frombytes(view[offset : offset + size])
+        if sys.byteorder == "big":
+            column.byteswap()
+        columns[name] = column
+        offset += size
+    return columns
@@ -0,0 +1,403 @@
+"""
+Sampler daemon shared by the profiled tasks of a host.
+
+The first task that subscribes starts it. Each task sends the name of its
+`SampleRing` over a Unix socket and keeps the connection open for as long as
+it wants samples: open connections are the daemon's reference count. The host
+is read once per tick of each sampling interval whatever the number of
+subscribers; only the process tree of each task (`scope="task"`) is read per
+subscriber. The daemon exits once it has had no subscriber for DAEMON_LINGER
+seconds, and logs its errors to a file next to its socket.
+"""
+import fcntl
+import json
+import math
+import os
+import selectors
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import traceback
+
+from profiler_ringbuffer import SampleRing
+from profiler_sampler import (
+    ProcessTreeSampler,
+    SystemSampler,
+    make_cgroup,
+    make_host,
+    make_processes,
+    sample_fields,
+    TOP_PROCESSES,
+)
+
+# Seconds the daemon keeps running without subscribers, so that the tasks of
+# a foreach starting one after the other reuse it.
+DAEMON_LINGER = 10.0
+
+# Seconds a task waits for the daemon to answer its subscription.
+DAEMON_TIMEOUT = 10.0
+
+
+class DaemonError(Exception):
+    pass
+
+
+def daemon_log(address):
+    return address + ".log"
+
+
+def daemon_address(backend="psutil"):
+    return os.path.join(
+        tempfile.gettempdir(), "metaflow-profiler-%d-%s.sock" % (os.getuid(), backend)
+    )
+
+
+class _Lock:
+    # Serializes starting the daemon against the daemon shutting down.
+    def __init__(self, address, blocking=True):
+        self.path = address + ".lock"
+        self.blocking = blocking
+        self._file = None
+
+    def acquire(self):
+        self._file = open(self.path, "a")
+        try:
+            fcntl.flock(
+                self._file, fcntl.LOCK_EX if self.blocking else fcntl.LOCK_EX | fcntl.LOCK_NB
+            )
+        except BlockingIOError:
+            self.release()
+            return False
+        return True
+
+    def release(self):
+        self._file.close()
+        self._file = None
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *args):
+        self.release()
+
+
+class Subscriber:
+    __slots__ = ("ring", "interval", "tree", "cgroup_path", "next")
+
+    def __init__(self, ring, interval, tree, cgroup_path):
+        self.ring = ring
+        self.interval = interval
+        self.tree = tree
+        self.cgroup_path = cgroup_path
+        self.next = None
+
+
+class SamplerDaemon:
+    """
+    Writes a sample to the ring of every subscriber on its own interval.
+
+    Deadlines of all subscribers sit on one grid, multiples of their interval
+    since the daemon started, so subscribers with the same interval share
+    every read of the host. Each interval has its own host sampler, since CPU
+    and I/O rates are computed over the time since its previous read.
+    """
+
+    def __init__(self, address, backend="psutil"):
+        self.address = address
+        self.backend = backend
+        self.subscribers = {}
+        self._buffers = {}
+        self._cgroups = {}
+        self._hosts = {}
+        self._listener = None
+        self._selector = None
+
+    def bind(self):
+        if os.path.exists(self.address):
+            os.unlink(self.address)
+        self._listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._listener.bind(self.address)
+        self._listener.listen(64)
+
+    def serve(self):
+        self._start_wall = time.time()
+        self._start = time.monotonic()
+        self._selector = selectors.DefaultSelector()
+        self._selector.register(self._listener, selectors.EVENT_READ)
+        idle_since = self._start
+        while True:
+            now = time.monotonic()
+            if self.subscribers:
+                timeout = min(s.next for s in self.subscribers.values()) - now
+            else:
+                timeout = idle_since + DAEMON_LINGER - now
+            for key, _ in self._selector.select(max(0.0, timeout)):
+                if key.fileobj is self._listener:
+                    self._accept()
+                else:
+                    self._receive(key.fileobj)
+            now = time.monotonic()
+            if self.subscribers:
+                self._sample(now)
+                idle_since = now
+            elif now - idle_since >= DAEMON_LINGER and self._shutdown():
+                return
+
+    def _accept(self):
+        try:
+            conn, _ = self._listener.accept()
+        except BlockingIOError:
+            return False
+        conn.setblocking(False)
+        self._buffers[conn] = b""
+        self._selector.register(conn, selectors.EVENT_READ)
+        return True
+
+    def _receive(self, conn):
+        try:
+            data = conn.recv(4096)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            data = b""
+        if not data:
+            self._drop(conn)
+            return
+        if conn in self.subscribers:
+            # Subscribers send nothing after their request.
+            return
+        self._buffers[conn] += data
+        if b"\n" not in self._buffers[conn]:
+            return
+        line = self._buffers[conn].split(b"\n", 1)[0]
+        try:
+            self._subscribe(conn, json.loads(line))
+            reply = {"status": "ok", "pid": os.getpid()}
+        except Exception as ex:
+            reply = {"status": "error", "error": str(ex)}
+        try:
+            conn.sendall(json.dumps(reply).encode("utf-8") + b"\n")
+        except OSError:
+            self._drop(conn)
+            return
+        if reply["status"] != "ok":
+            self._drop(conn)
+
+    def _subscribe(self, conn, request):
+        scope = request.get("scope", "host")
+        top_processes = request.get("top_processes", TOP_PROCESSES)
+        cgroup_path = request.get("cgroup_path")
+        fields = sample_fields(scope, top_processes, cgroup=cgroup_path is not None)
+        if tuple(request["fields"]) != fields:
+            raise DaemonError("Unexpected fields for scope %r" % scope)
+        ring = SampleRing(fields, request["capacity"], name=request["ring"], track=False)
+        tree = None
+        if scope == "task":
+            tree = ProcessTreeSampler(
+                request["root_pid"],
+                make_processes(self.backend),
+                top_processes,
+                exclude=(os.getpid(),),
+            )
+        if cgroup_path is not None and cgroup_path not in self._cgroups:
+            self._cgroups[cgroup_path] = [make_cgroup(self.backend, cgroup_path), None]
+        interval = request["interval"]
+        if interval not in self._hosts:
+            self._hosts[interval] = SystemSampler(interval, make_host(self.backend))
+        subscriber = Subscriber(ring, interval, tree, cgroup_path)
+        subscriber.next = self._next_deadline(subscriber, time.monotonic())
+        self.subscribers[conn] = subscriber
+
+    def _drop(self, conn):
+        subscriber = self.subscribers.pop(conn, None)
+        if subscriber is not None:
+            subscriber.ring.close()
+            if subscriber.cgroup_path is not None and not any(
+                s.cgroup_path == subscriber.cgroup_path for s in self.subscribers.values()
+            ):
+                del self._cgroups[subscriber.cgroup_path]
+            if not any(s.interval == subscriber.interval for s in self.subscribers.values()):
+                del self._hosts[subscriber.interval]
+        self._buffers.pop(conn, None)
+        self._selector.unregister(conn)
+        conn.close()
+
+    def _next_deadline(self, subscriber, now):
+        ticks = math.floor((now - self._start) / subscriber.interval) + 1
+        return self._start + ticks * subscriber.interval
+
+    def _sample(self, now):
+        due = [
+            (conn, s) for conn, s in self.subscribers.items() if s.next <= now
+        ]
+        hosts = {}
+        for conn, subscriber in due:
+            # Subscribers due at the same tick on the same interval share it.
+            if subscriber.interval not in hosts:
+                try:
+                    hosts[subscriber.interval] = self._hosts[subscriber.interval].sample(
+                        self._start_wall + (now - self._start), now
+                    )
+                except Exception:
+                    traceback.print_exc()
+                    hosts[subscriber.interval] = None
+            host = hosts[subscriber.interval]
+            if host is None:
+                # Skipped, the next tick tries again.
+                subscriber.next = self._next_deadline(subscriber, now)
+                continue
+            try:
+                sample = host
+                if subscriber.tree is not None:
+                    sample += subscriber.tree.sample(now)
+                if subscriber.cgroup_path is not None:
+                    sample += self._cgroup_sample(subscriber.cgroup_path, now)
+                subscriber.ring.write(sample)
+            except Exception:
+                traceback.print_exc()
+                self._drop(conn)
+                continue
+            subscriber.next = self._next_deadline(subscriber, now)
+
+    def _cgroup_sample(self, path, now):
+        # Read once per tick for all the subscribers in the same cgroup.
+        cgroup = self._cgroups[path]
+        if cgroup[1] is None or cgroup[1][0] != now:
+            cgroup[1] = (now, cgroup[0].sample(now))
+        return cgroup[1][1]
+
+    def _shutdown(self):
+        lock = _Lock(self.address, blocking=False)
+        if not lock.acquire():
+            return False
+        try:
+            # A task may have connected right before we took the lock.
+            self._listener.setblocking(False)
+            if self._accept():
+                self._listener.setblocking(True)
+                return False
+            os.unlink(self.address)
+            self._listener.close()
+            return True
+        finally:
+            lock.release()
+
+
+def start_daemon(address, backend):
+    # The launcher binds the socket, then leaves the daemon to init, outside
+    # the process tree (and the session) of the task that started it.
+    with open(daemon_log(address), "a") as log:
+        launcher = subprocess.Popen(
+            [sys.executable, os.path.abspath(__file__), address, backend],
+            stdin=subprocess.DEVNULL,
+            stdout=log,
+            stderr=log,
+            start_new_session=True,
+            close_fds=True,
+        )
+    try:
+        code = launcher.wait(DAEMON_TIMEOUT)
+    except subprocess.TimeoutExpired:
+        launcher.kill()
+        raise DaemonError("The profiler daemon did not start in %ds" % DAEMON_TIMEOUT)
+    if code != 0:
+        raise DaemonError(
+            "The profiler daemon failed to start, see %s" % daemon_log(address)
+        )
+
+
+class DaemonSubscription:
+    """
+    Subscribes `ring` to the samples of the daemon of `backend`, starting the
+    daemon if none runs. Samples keep coming until `close`.
+    """
+
+    def __init__(
+        self,
+        ring,
+        interval,
+        backend="psutil",
+        scope="host",
+        root_pid=None,
+        top_processes=TOP_PROCESSES,
+        cgroup_path=None,
+    ):
+        address = daemon_address(backend)
+        request = {
+            "ring": ring.name,
+            "fields": ring.fields,
+            "capacity": ring.capacity,
+            "interval": interval,
+            "scope": scope,
+            "root_pid": root_pid,
+            "top_processes": top_processes,
+            "cgroup_path": cgroup_path,
+        }
+        try:
+            with _Lock(address):
+                try:
+                    self._sock = self._connect(address)
+                except (FileNotFoundError, ConnectionRefusedError):
+                    start_daemon(address, backend)
+                    self._sock = self._connect(address)
+        except OSError as ex:
+            raise DaemonError("Cannot connect to the profiler daemon: %s" % ex)
+        try:
+            self._sock.sendall(json.dumps(request).encode("utf-8") + b"\n")
+            reply = self._sock.makefile("rb").readline()
+            reply = json.loads(reply) if reply else {"error": "connection closed"}
+        except (OSError, ValueError) as ex:
+            self._sock.close()
+            raise DaemonError("The profiler daemon did not answer: %s" % ex)
+        if reply.get("status") != "ok":
+            self._sock.close()
+            raise DaemonError(
+                "The profiler daemon refused the task: %s" % reply.get("error")
+            )
+        self.pid = reply["pid"]
+        self._sock.setblocking(False)
+
+    @staticmethod
+    def _connect(address):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(DAEMON_TIMEOUT)
+        try:
+            sock.connect(address)
+        except OSError:
+            sock.close()
+            raise
+        return sock
+
+    def alive(self):
+        # The daemon sends nothing after its reply, so the socket only becomes
+        # readable once the daemon closed it: it exited or dropped the task.
+        try:
+            return self._sock.recv(1, socket.MSG_PEEK) != b""
+        except BlockingIOError:
+            return True
+        except OSError:
+            return False
+
+    def close(self):
+        self._sock.close()
+
+
+def main(address, backend):
+    daemon = SamplerDaemon(address, backend)
+    daemon.bind()
+    if os.fork():
+        os._exit(0)
+    try:
+        daemon.serve()
+    except Exception:
+        # Exiting closes the connections, so tasks see the daemon is gone.
+        traceback.print_exc()
+        os.unlink(daemon.address)
+        raise
+
+
+if __name__ == "__main__":
+    main(*sys.argv[1:3])
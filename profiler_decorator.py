@@ -1,17 +1,149 @@
 from metaflow.cards import Markdown, Table
 from metaflow.plugins.cards.card_modules.basic import DefaultComponent
 from functools import wraps
+import os
 import threading
 import multiprocessing
 from datetime import datetime
 from metaflow import current
 import time
 
+from profiler_ringbuffer import SampleRing, RING_CAPACITY
+from profiler_columns import SampleColumns
+from profiler_stacks import StackSampler, STACK_INTERVAL, MAX_STACK_NODES
+from profiler_memory import (
+    AllocationTracker,
+    SNAPSHOT_INTERVAL,
+    SNAPSHOT_FRAMES,
+    TOP_ALLOCATIONS,
+)
+from profiler_daemon import DaemonSubscription, DaemonError
+from profiler_sampler import (
+    make_sampler,
+    sample_fields,
+    detect_cgroup,
+    TOP_PROCESSES,
+    BACKENDS,
+    SCOPES,
+)
+
+MB = 1024 * 1024
+
+# Smallest change of a metric since the last refresh of the card that makes
+# it refresh again; metrics not listed here (e.g. uptime) never do on their own.
+REFRESH_THRESHOLDS = {
+    "cpu": 2.0,
+    "memory": 0.5,
+    "disk": 0.1,
+    "processes": 1,
+    "load1": 0.1,
+    "disk_read": MB,
+    "disk_write": MB,
+    "net_rx": 0.1 * MB,
+    "net_tx": 0.1 * MB,
+    "task_cpu": 2.0,
+    "task_rss": 8 * MB,
+    "task_io_read": MB,
+    "task_io_write": MB,
+    "task_processes": 1,
+    "cgroup_cpu": 2.0,
+    "cgroup_throttled": 1.0,
+    "cgroup_memory_percent": 0.5,
+}
+
+# Seconds after which the card is refreshed even if no metric moved past its
+# threshold, so the charts and the latest reading keep going.
+MAX_REFRESH_AGE = 10.0
+
+# The card is refreshed at most once every that many times the time its last
+# refreshes took, so a slow card pipeline gets refreshed less often.
+RENDER_LATENCY_FACTOR = 4
+
+
+def sample_system(
+    ring,
+    interval,
+    backend="psutil",
+    scope="host",
+    root_pid=None,
+    top_processes=TOP_PROCESSES,
+    cgroup_path=None,
+):
+    # Runs in the sidecar process; only the ring is shared with the step.
+    sampler = make_sampler(
+        interval,
+        backend=backend,
+        scope=scope,
+        root_pid=root_pid,
+        top_processes=top_processes,
+        cgroup_path=cgroup_path,
+        exclude=(os.getpid(),),
+    )
+    ring.resume()
+    sampler.run(ring)
+
+
 class Profiler:
-    def __init__(self, filename, interval):
-        from nn_card import LineChart
-        self.filename = filename
+    def __init__(
+        self,
+        interval,
+        sample_interval=None,
+        scope="host",
+        top_processes=TOP_PROCESSES,
+        backend="psutil",
+        stacks=False,
+        stack_interval=STACK_INTERVAL,
+        stack_max_nodes=MAX_STACK_NODES,
+        allocations=False,
+        snapshot_interval=SNAPSHOT_INTERVAL,
+        snapshot_frames=SNAPSHOT_FRAMES,
+        top_allocations=TOP_ALLOCATIONS,
+        refresh_thresholds=None,
+        max_refresh_age=MAX_REFRESH_AGE,
+        capacity=RING_CAPACITY,
+    ):
+        from nn_card import LineChart, FlameGraph
         self.interval = interval
+        self.sample_interval = sample_interval or interval
+        self.scope = scope
+        self.top_processes = top_processes
+        self.backend = backend
+        self.cgroup_path = detect_cgroup(backend)
+        self.fields = sample_fields(scope, top_processes, cgroup=self.cgroup_path is not None)
+        self.ring = SampleRing(self.fields, capacity)
+        self.columns = SampleColumns(self.fields)
+        self.stacks = None
+        if stacks:
+            self.stacks = StackSampler(stack_interval, max_nodes=stack_max_nodes)
+            self.flame_graph = FlameGraph(
+                title="Python Stacks (sampled every %gms)" % (stack_interval * 1000)
+            )
+        self.allocations = None
+        if allocations:
+            self.allocations = AllocationTracker(
+                snapshot_interval, frames=snapshot_frames, top=top_allocations
+            )
+            self.allocation_table = Markdown(self.allocations.table())
+        thresholds = dict(REFRESH_THRESHOLDS, **(refresh_thresholds or {}))
+        self.refresh_thresholds = {
+            field: threshold for field, threshold in thresholds.items() if field in self.fields
+        }
+        self.max_refresh_age = max_refresh_age
+        self.render_latency = 0.0
+        self.refreshes = 0
+        self._refreshed = None
+        self._refreshed_at = None
+        self._changed = False
+        self._snapshots = 0
+        self._rows = {}
+        self._names = {}
+        self._stop = threading.Event()
+        # Where the samples come from, see `start_sampling`.
+        self.subscription = None
+        self.sidecar_process = None
+        self.notice = None
+        self._sampling = False
+        self._sampler_lock = threading.Lock()
         self.latest_reading = Markdown("*Initializing profiler...*")
         self.charts = {
             "cpu_chart": LineChart(
@@ -23,6 +155,7 @@ class Profiler:
                 width=600,
                 height=400,
                 x_axis_temporal=True,
+                downsample="minmax",
             ),
             "memory_chart": LineChart(
                 ytitle="Memory Usage",
@@ -33,16 +166,62 @@ class Profiler:
                 width=600,
                 height=400,
                 x_axis_temporal=True,
+                downsample="minmax",
+            ),
+            "disk_read_chart": LineChart(
+                ytitle="MB/s",
+                xtitle="Time",
+                x_name="time",
+                y_name="read",
+                title="Disk Read Throughput",
+                width=600,
+                height=400,
+                x_axis_temporal=True,
+                downsample="minmax",
+            ),
+            "disk_write_chart": LineChart(
+                ytitle="MB/s",
+                xtitle="Time",
+                x_name="time",
+                y_name="write",
+                title="Disk Write Throughput",
+                width=600,
+                height=400,
+                x_axis_temporal=True,
+                downsample="minmax",
             ),
-            "disk_chart": LineChart(
-                ytitle="Disk Usage",
+            "disk_iops_chart": LineChart(
+                ytitle="Operations/s (reads + writes)",
                 xtitle="Time",
                 x_name="time",
-                y_name="disk",
-                title="Disk Utilization",
+                y_name="iops",
+                title="Disk IOPS",
                 width=600,
                 height=400,
                 x_axis_temporal=True,
+                downsample="minmax",
+            ),
+            "network_rx_chart": LineChart(
+                ytitle="MB/s",
+                xtitle="Time",
+                x_name="time",
+                y_name="rx",
+                title="Network Receive Throughput",
+                width=600,
+                height=400,
+                x_axis_temporal=True,
+                downsample="minmax",
+            ),
+            "network_tx_chart": LineChart(
+                ytitle="MB/s",
+                xtitle="Time",
+                x_name="time",
+                y_name="tx",
+                title="Network Transmit Throughput",
+                width=600,
+                height=400,
+                x_axis_temporal=True,
+                downsample="minmax",
             ),
             "process_chart": LineChart(
                 ytitle="Number of Running Processes",
@@ -53,6 +232,7 @@ class Profiler:
                 width=600,
                 height=400,
                 x_axis_temporal=True,
+                downsample="minmax",
             ),
             "load_chart": LineChart(
                 ytitle="Load Average",
@@ -63,7 +243,7 @@ class Profiler:
                 width=600,
                 height=400,
                 x_axis_temporal=True,
-
+                downsample="minmax",
             ),
             "uptime_chart": LineChart(
                 ytitle="System Uptime",
@@ -74,96 +254,453 @@ class Profiler:
                 width=600,
                 height=400,
                 x_axis_temporal=True,
+                downsample="minmax",
             ),
         }
+        if self.cgroup_path is not None:
+            self.charts["container_cpu_chart"] = LineChart(
+                ytitle="CPU % of the quota",
+                xtitle="Time",
+                x_name="time",
+                y_name="cpu",
+                title="Container CPU Utilization",
+                width=600,
+                height=400,
+                x_axis_temporal=True,
+                downsample="minmax",
+            )
+            self.charts["throttling_chart"] = LineChart(
+                ytitle="Throttled time %",
+                xtitle="Time",
+                x_name="time",
+                y_name="throttled",
+                title="Container CPU Throttling",
+                width=600,
+                height=400,
+                x_axis_temporal=True,
+                downsample="minmax",
+            )
+            self.charts["container_memory_chart"] = LineChart(
+                ytitle="Memory % of the limit",
+                xtitle="Time",
+                x_name="time",
+                y_name="memory",
+                title="Container Memory Utilization",
+                width=600,
+                height=400,
+                x_axis_temporal=True,
+                downsample="minmax",
+            )
+        if scope == "task":
+            self.process_table = Markdown("*Waiting for the first task sample...*")
+            self.charts["task_cpu_chart"] = LineChart(
+                ytitle="CPU % (100 = one core)",
+                xtitle="Time",
+                x_name="time",
+                y_name="cpu",
+                title="Task CPU Utilization",
+                width=600,
+                height=400,
+                x_axis_temporal=True,
+                downsample="minmax",
+            )
+            self.charts["task_memory_chart"] = LineChart(
+                ytitle="RSS (MB)",
+                xtitle="Time",
+                x_name="time",
+                y_name="rss",
+                title="Task Memory",
+                width=600,
+                height=400,
+                x_axis_temporal=True,
+                downsample="minmax",
+            )
+            self.charts["task_io_chart"] = LineChart(
+                ytitle="MB/s (reads + writes)",
+                xtitle="Time",
+                x_name="time",
+                y_name="io",
+                title="Task Disk I/O",
+                width=600,
+                height=400,
+                x_axis_temporal=True,
+                downsample="minmax",
+            )
 
-    def collect_data(self):
-        import psutil
-        import os
-        import time
-        import json
-
-        while True:
-            data = {
-                "CPU Usage": psutil.cpu_percent(interval=1),
-                "Memory Usage": psutil.virtual_memory().percent,
-                "Disk Usage": psutil.disk_usage("/").percent,
-                "Number of Running Processes": len(psutil.pids()),
-                "Load Average": os.getloadavg(),
-                "System Uptime": time.time() - psutil.boot_time(),
-            }
-            with open(self.filename, "w") as file:
-                json.dump(data, file)
-            time.sleep(self.interval)
-
-    def _safely_read_file(self):
-        import json
-
-        try:
-            with open(self.filename, "r") as file:
-                data = json.load(file)
-        except FileNotFoundError:
-            data = None
-        except json.decoder.JSONDecodeError:
-            data = None
-        return data
+    def drain(self):
+        # Every sample is kept at full resolution for the artifact.
+        samples = self.ring.drain()
+        for sample in samples:
+            self.columns.append(sample)
+        return samples
+
+    def _sampler_args(self):
+        return (
+            self.ring,
+            self.sample_interval,
+            self.backend,
+            self.scope,
+            os.getpid(),
+            self.top_processes,
+            self.cgroup_path,
+        )
+
+    def start_sampling(self, shared=False):
+        # Samples come from the per-host daemon if `shared` and it can be
+        # reached, else from a sidecar process of the task.
+        with self._sampler_lock:
+            self._sampling = True
+            if shared:
+                try:
+                    self.subscription = DaemonSubscription(*self._sampler_args())
+                    return
+                except DaemonError as ex:
+                    print("Profiler daemon unavailable, sampling in-task: %s" % ex)
+            self._start_sidecar()
+
+    def _start_sidecar(self):
+        self.sidecar_process = multiprocessing.Process(
+            target=sample_system, args=self._sampler_args()
+        )
+        self.sidecar_process.start()
+
+    def _check_daemon(self):
+        # A daemon that goes away stops writing to the ring without telling
+        # the task, so the sidecar takes over for the rest of the step.
+        with self._sampler_lock:
+            if not self._sampling or self.subscription is None:
+                return
+            if self.subscription.alive():
+                return
+            self.subscription.close()
+            self.subscription = None
+            self.notice = "Profiler daemon stopped at %s, sampling in-task since" % (
+                datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S")
+            )
+            print(self.notice)
+            self._start_sidecar()
+            self._changed = True
+
+    def stop_sampling(self):
+        with self._sampler_lock:
+            self._sampling = False
+            if self.subscription is not None:
+                self.subscription.close()
+            if self.sidecar_process is not None:
+                self.sidecar_process.terminate()
+                self.sidecar_process.join()
 
     def update_card(self):
-        import json
-        from metaflow.cards import Markdown
+        sample = None
+        while not self._stop.is_set():
+            self._check_daemon()
+            # Every sample goes to the charts, the tables show the latest one.
+            for values in self.drain():
+                sample = dict(zip(self.fields, values))
+                self._update_charts(sample)
+                if not self._changed and self._moved(sample):
+                    self._changed = True
+            if sample is not None and self._should_refresh():
+                self._refresh(sample)
+            self._stop.wait(max(self.interval, RENDER_LATENCY_FACTOR * self.render_latency))
 
-        while True:
-            data = self._safely_read_file()
-            if data is None:
-                time.sleep(self.interval)
-                continue
-            table_data = "\n".join(
-                f"| {key} | {value} |" for key, value in data.items()
+    def _moved(self, sample):
+        if self._refreshed is None:
+            return True
+        return any(
+            abs(sample[field] - self._refreshed[field]) >= threshold
+            for field, threshold in self.refresh_thresholds.items()
+        )
+
+    def _should_refresh(self):
+        if self._changed:
+            return True
+        if self.allocations is not None and self.allocations.snapshots != self._snapshots:
+            return True
+        return time.monotonic() - self._refreshed_at >= self.max_refresh_age
+
+    def _refresh(self, sample):
+        current.card["system_profile"].components["profiler_table"].update(
+            self._metrics_table(sample)
+        )
+        if self.scope == "task":
+            self.process_table.update(self._process_table(sample))
+        if self.stacks is not None:
+            self.flame_graph.update(self.stacks.rows())
+        if self.allocations is not None:
+            self._snapshots = self.allocations.snapshots
+            self.allocation_table.update(self.allocations.table())
+        reading = "*Latest Reading on: %s*" % self._timestamp(sample)
+        if self.notice is not None:
+            reading += "\n\n**%s.**" % self.notice
+        self.latest_reading.update(reading)
+        start = time.monotonic()
+        current.card["system_profile"].refresh()
+        self._refreshed_at = time.monotonic()
+        # Smoothed, so that one slow refresh does not stall the next ones.
+        self.render_latency = 0.8 * self.render_latency + 0.2 * (self._refreshed_at - start)
+        self._refreshed = sample
+        self._changed = False
+        self.refreshes += 1
+
+    @staticmethod
+    def _timestamp(sample):
+        return datetime.utcfromtimestamp(sample["time"]).strftime(
+            "%Y-%m-%d %H:%M:%S.%f"
+        )[:-3]
+
+    def _update_charts(self, sample):
+        timestamp = self._timestamp(sample)
+        self.charts["cpu_chart"].update(dict(cpu=sample["cpu"], time=timestamp))
+        self.charts["memory_chart"].update(dict(memory=sample["memory"], time=timestamp))
+        self.charts["disk_read_chart"].update(
+            dict(read=sample["disk_read"] / MB, time=timestamp)
+        )
+        self.charts["disk_write_chart"].update(
+            dict(write=sample["disk_write"] / MB, time=timestamp)
+        )
+        self.charts["disk_iops_chart"].update(
+            dict(iops=sample["disk_read_iops"] + sample["disk_write_iops"], time=timestamp)
+        )
+        self.charts["network_rx_chart"].update(dict(rx=sample["net_rx"] / MB, time=timestamp))
+        self.charts["network_tx_chart"].update(dict(tx=sample["net_tx"] / MB, time=timestamp))
+        self.charts["process_chart"].update(
+            dict(process=sample["processes"], time=timestamp)
+        )
+        self.charts["load_chart"].update(dict(load=sample["load1"], time=timestamp))
+        self.charts["uptime_chart"].update(dict(uptime=sample["uptime"], time=timestamp))
+        if self.cgroup_path is not None:
+            self.charts["container_cpu_chart"].update(
+                dict(cpu=sample["cgroup_cpu"], time=timestamp)
             )
-            table_md = f"| Metric | Value |\n| --- | --- |\n{table_data}"
-            current.card["system_profile"].components["profiler_table"].update(table_md)
-            current_timestamp = datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S")
-            self.latest_reading.update(
-                "*Latest Reading on: %s*" % current_timestamp,
+            self.charts["throttling_chart"].update(
+                dict(throttled=sample["cgroup_throttled"], time=timestamp)
             )
-            self.charts["cpu_chart"].update(
-                dict(cpu=data["CPU Usage"], time=current_timestamp)
+            self.charts["container_memory_chart"].update(
+                dict(memory=sample["cgroup_memory_percent"], time=timestamp)
             )
-            self.charts["memory_chart"].update(
-                dict(memory=data["Memory Usage"], time=current_timestamp)
-                # data=data["Memory Usage"], labels=current_timestamp
+        if self.scope == "task":
+            self.charts["task_cpu_chart"].update(dict(cpu=sample["task_cpu"], time=timestamp))
+            self.charts["task_memory_chart"].update(
+                dict(rss=sample["task_rss"] / MB, time=timestamp)
             )
-            self.charts["disk_chart"].update(
-                dict(disk=data["Disk Usage"], time=current_timestamp)
-                # data=data["Disk Usage"], labels=current_timestamp
+            self.charts["task_io_chart"].update(
+                dict(io=(sample["task_io_read"] + sample["task_io_write"]) / MB, time=timestamp)
             )
-            self.charts["process_chart"].update(
-                dict(process=data["Number of Running Processes"], time=current_timestamp)
-                # data=data["Number of Running Processes"], labels=current_timestamp
+
+    def _row(self, key, fmt, values):
+        # Rows are formatted again only when their values changed.
+        cached = self._rows.get(key)
+        if cached is None or cached[0] != values:
+            cached = self._rows[key] = (values, fmt % values)
+        return cached[1]
+
+    def _metrics_table(self, sample):
+        metrics = [
+            ("CPU Usage", "%s", (sample["cpu"],)),
+            ("Memory Usage", "%s", (sample["memory"],)),
+            ("Disk Usage", "%s", (sample["disk"],)),
+            (
+                "Disk I/O",
+                "%.1f MB/s read, %.1f MB/s written (%.0f IOPS)",
+                (
+                    sample["disk_read"] / MB,
+                    sample["disk_write"] / MB,
+                    sample["disk_read_iops"] + sample["disk_write_iops"],
+                ),
+            ),
+            (
+                "Network",
+                "%.2f MB/s received, %.2f MB/s sent",
+                (sample["net_rx"] / MB, sample["net_tx"] / MB),
+            ),
+            ("Number of Running Processes", "%d", (sample["processes"],)),
+            (
+                "Load Average",
+                "%s",
+                ((sample["load1"], sample["load5"], sample["load15"]),),
+            ),
+            ("System Uptime", "%s", (sample["uptime"],)),
+        ]
+        if self.cgroup_path is not None:
+            metrics.append(
+                (
+                    "Container CPU Usage",
+                    "%.1f%% of %.2f cores",
+                    (sample["cgroup_cpu"], sample["cgroup_cpu_limit"]),
+                )
             )
-            self.charts["load_chart"].update(
-                dict(load=data["Load Average"][0], time=current_timestamp)
-                # data=data["Load Average"][0], labels=current_timestamp
+            metrics.append(
+                ("Container CPU Throttled", "%.1f%%", (sample["cgroup_throttled"],))
             )
-            self.charts["uptime_chart"].update(
-                dict(uptime=data["System Uptime"], time=current_timestamp)
-                # data=data["System Uptime"], labels=current_timestamp
+            metrics.append(
+                (
+                    "Container Memory Usage",
+                    "%.1f MB (%.1f%% of %s)",
+                    (
+                        sample["cgroup_memory"] / MB,
+                        sample["cgroup_memory_percent"],
+                        "%.0f MB" % (sample["cgroup_memory_limit"] / MB)
+                        if sample["cgroup_memory_limit"]
+                        else "host memory",
+                    ),
+                )
             )
-            current.card["system_profile"].refresh()
-            time.sleep(self.interval)
+        if self.ring.lost:
+            metrics.append(("Samples Dropped", "%d", (self.ring.lost,)))
+        rows = ["| Metric | Value |", "| --- | --- |"]
+        for label, fmt, values in metrics:
+            rows.append(self._row(label, "| %s | %s |" % (label, fmt), values))
+        return "\n".join(rows)
+
+    def _process_name(self, pid):
+        import psutil
+
+        if pid not in self._names:
+            try:
+                self._names[pid] = psutil.Process(pid).name()
+            except psutil.Error:
+                self._names[pid] = "?"
+        return self._names[pid]
+
+    def _process_table(self, sample):
+        def row(name, pid, prefix):
+            return self._row(
+                prefix,
+                "| %s | %s | %.1f | %.1f | %.1f | %d | %d | %.0f | %.2f | %.2f |",
+                (
+                    name,
+                    pid,
+                    sample[prefix + "cpu"],
+                    sample[prefix + "rss"] / MB,
+                    sample[prefix + "uss"] / MB,
+                    sample[prefix + "threads"],
+                    sample[prefix + "fds"],
+                    sample[prefix + "ctx_switches"],
+                    sample[prefix + "io_read"] / MB,
+                    sample[prefix + "io_write"] / MB,
+                ),
+            )
+
+        rows = [
+            "| Process | PID | CPU % | RSS (MB) | USS (MB) | Threads | Open files"
+            " | Context switches/s | Read (MB/s) | Written (MB/s) |",
+            "| --- | --- | --- | --- | --- | --- | --- | --- | --- | --- |",
+            row("**task (%d processes)**" % sample["task_processes"], "", "task_"),
+        ]
+        for i in range(self.top_processes):
+            pid = int(sample["proc%d_pid" % i])
+            if pid:
+                rows.append(row(self._process_name(pid), pid, "proc%d_" % i))
+        return "\n".join(rows)
+
+    def stop(self):
+        self._stop.set()
 
 
 class profiler:
-    def __init__(self, with_card=True, interval=0.5):
+    """
+    `interval` is how often the card is refreshed, `sample_interval` how often
+    the host is sampled (by default as often); it can go down to 50ms, every
+    sample ends up in the charts.
+
+    With `scope="task"` the card also shows the processes of the step: its
+    own and all its descendants, in total and for the `top_processes` busiest.
+
+    `backend="procfs"` reads /proc directly instead of going through psutil,
+    which is cheaper at high sampling rates, and on cgroup v2 also reports
+    CPU and memory against the container's quota and limit, and throttling.
+
+    Every sample is stored in the `artifact` artifact of the step (unless it
+    is None) in a columnar binary format; read it with
+    `profiler_columns.load_samples`.
+
+    `stacks=True` also samples the Python stacks of the step's threads every
+    `stack_interval` seconds into a live flame graph, keeping at most
+    `stack_max_nodes` distinct frames.
+
+    `allocations=True` traces allocations with `tracemalloc` and shows the
+    `top_allocations` sites that grew the most between two snapshots, taken
+    every `snapshot_interval` seconds with `snapshot_frames` frames per site.
+
+    `shared=True` takes the samples from the per-host daemon of
+    `profiler_daemon` instead of a sampler process of the task's own, so that
+    many profiled tasks on one host read the host only once per interval.
+    If the daemon cannot be reached, or goes away during the step, the task
+    samples with a sidecar process of its own instead.
+
+    The card is refreshed only when a metric moved by more than its
+    `refresh_thresholds` entry (see `REFRESH_THRESHOLDS`) since the last
+    refresh, or `max_refresh_age` seconds after it, and no more often than the
+    time refreshes take allows.
+    """
+
+    def __init__(
+        self,
+        with_card=True,
+        interval=0.5,
+        sample_interval=None,
+        scope="host",
+        top_processes=TOP_PROCESSES,
+        backend="psutil",
+        artifact="profiler_samples",
+        stacks=False,
+        stack_interval=STACK_INTERVAL,
+        stack_max_nodes=MAX_STACK_NODES,
+        allocations=False,
+        snapshot_interval=SNAPSHOT_INTERVAL,
+        snapshot_frames=SNAPSHOT_FRAMES,
+        top_allocations=TOP_ALLOCATIONS,
+        shared=False,
+        refresh_thresholds=None,
+        max_refresh_age=MAX_REFRESH_AGE,
+    ):
+        if backend not in BACKENDS:
+            raise ValueError(
+                "Unknown profiler backend %r, use one of %s" % (backend, ", ".join(BACKENDS))
+            )
+        if scope not in SCOPES:
+            raise ValueError(
+                "Unknown profiler scope %r, use one of %s" % (scope, ", ".join(SCOPES))
+            )
         self.with_card = with_card
         self.interval = interval
+        self.sample_interval = sample_interval
+        self.scope = scope
+        self.top_processes = top_processes
+        self.backend = backend
+        self.artifact = artifact
+        self.stacks = stacks
+        self.stack_interval = stack_interval
+        self.stack_max_nodes = stack_max_nodes
+        self.allocations = allocations
+        self.snapshot_interval = snapshot_interval
+        self.snapshot_frames = snapshot_frames
+        self.top_allocations = top_allocations
+        self.shared = shared
+        self.refresh_thresholds = refresh_thresholds
+        self.max_refresh_age = max_refresh_age
 
     def __call__(self, f):
         @wraps(f)
         def func(s):
-            prof = Profiler("system_data.txt", interval=self.interval)
-            sidecar_process = multiprocessing.Process(target=prof.collect_data)
-            sidecar_process.start()
+            prof = Profiler(
+                interval=self.interval,
+                sample_interval=self.sample_interval,
+                scope=self.scope,
+                top_processes=self.top_processes,
+                backend=self.backend,
+                stacks=self.stacks,
+                stack_interval=self.stack_interval,
+                stack_max_nodes=self.stack_max_nodes,
+                allocations=self.allocations,
+                snapshot_interval=self.snapshot_interval,
+                snapshot_frames=self.snapshot_frames,
+                top_allocations=self.top_allocations,
+                refresh_thresholds=self.refresh_thresholds,
+                max_refresh_age=self.max_refresh_age,
+            )
+            prof.start_sampling(self.shared)
             current.card["system_profile"].append(
                 Markdown("# Profiler Card for System Metrics (%s)" % current.pathspec)
             )
@@ -173,6 +710,21 @@ class profiler:
             current.card["system_profile"].append(
                 Markdown("Initializing cpu profile..."), id="profiler_table"
             )
+            if self.scope == "task":
+                current.card["system_profile"].append(
+                    Markdown("## Task Processes")
+                )
+                current.card["system_profile"].append(
+                    prof.process_table, id="process_table"
+                )
+            if prof.stacks is not None:
+                current.card["system_profile"].append(Markdown("## Python Stacks"))
+                current.card["system_profile"].append(prof.flame_graph, id="flame_graph")
+            if prof.allocations is not None:
+                current.card["system_profile"].append(Markdown("## Growing Allocations"))
+                current.card["system_profile"].append(
+                    prof.allocation_table, id="allocation_table"
+                )
             for chart_id, chart in prof.charts.items():
                 current.card["system_profile"].append(
                     Markdown("## %s Chart" % chart.spec["title"])
@@ -181,11 +733,28 @@ class profiler:
 
             update_thread = threading.Thread(target=prof.update_card, daemon=True)
             update_thread.start()
+            if prof.allocations is not None:
+                prof.allocations.start()
+            if prof.stacks is not None:
+                prof.stacks.ignore_thread(update_thread.ident)
+                if prof.allocations is not None:
+                    prof.stacks.ignore_thread(prof.allocations.ident)
+                prof.stacks.start()
 
             try:
                 f(s)
             finally:
-                sidecar_process.terminate()
+                if prof.stacks is not None:
+                    prof.stacks.stop()
+                if prof.allocations is not None:
+                    prof.allocations.stop()
+                prof.stop_sampling()
+                prof.stop()
+                update_thread.join()
+                prof.drain()
+                prof.ring.close()
+                if self.artifact:
+                    setattr(s, self.artifact, prof.columns.to_bytes())
 
         if self.with_card:
             from metaflow import card
@@ -0,0 +1,133 @@
+import os
+import threading
+import tracemalloc
+
+# Seconds between two tracemalloc snapshots.
+SNAPSHOT_INTERVAL = 5.0
+
+# Frames tracemalloc keeps per allocation; the cost of tracing and of each
+# snapshot grows with it. With more than one frame, sites are whole tracebacks.
+SNAPSHOT_FRAMES = 1
+
+# Allocation sites shown in the table, the ones that grew the most first.
+TOP_ALLOCATIONS = 10
+
+KB = 1024
+
+_HERE = os.path.dirname(os.path.abspath(__file__))
+
+# Allocations of tracemalloc, imports and of the profiler itself (its samples,
+# charts and card) are left out of the snapshots.
+_IGNORED = (
+    tracemalloc.Filter(False, tracemalloc.__file__),
+    tracemalloc.Filter(False, os.path.join(_HERE, "profiler_*.py")),
+    tracemalloc.Filter(False, os.path.join(_HERE, "charts.py")),
+    tracemalloc.Filter(False, os.path.join(_HERE, "nn_card.py")),
+    tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+    tracemalloc.Filter(False, "<frozen importlib._bootstrap_external>"),
+    tracemalloc.Filter(False, "<unknown>"),
+)
+
+
+def _site(traceback):
+    # Innermost frame first, then its callers.
+    return " <- ".join(
+        "%s:%d" % (os.path.basename(frame.filename), frame.lineno)
+        for frame in reversed(traceback)
+    )
+
+
+class AllocationTracker:
+    """
+    Takes a `tracemalloc` snapshot every `interval` seconds from a background
+    thread and diffs it against the previous one: `rows` are the `top`
+    allocation sites whose size grew the most in between.
+
+    Tracing is started with `frames` frames per allocation unless it already
+    runs, and stopped again by `stop` if it was started here.
+    """
+
+    def __init__(self, interval=SNAPSHOT_INTERVAL, frames=SNAPSHOT_FRAMES, top=TOP_ALLOCATIONS):
+        self.interval = interval
+        self.frames = frames
+        self.top = top
+        self.rows = []
+        self.snapshots = 0
+        self.traced = (0, 0)
+        self._previous = None
+        self._started = False
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(self.frames)
+            self._started = True
+        self._previous = self._snapshot()
+        self._thread = threading.Thread(
+            target=self._run, name="profiler-tracemalloc", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        self._previous = None
+        if self._started:
+            tracemalloc.stop()
+            self._started = False
+
+    @property
+    def ident(self):
+        return self._thread.ident if self._thread is not None else None
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.snapshot()
+
+    def _snapshot(self):
+        return tracemalloc.take_snapshot().filter_traces(_IGNORED)
+
+    def snapshot(self):
+        snapshot = self._snapshot()
+        key_type = "lineno" if self.frames == 1 else "traceback"
+        diff = snapshot.compare_to(self._previous, key_type)
+        self._previous = snapshot
+        growing = [stat for stat in diff if stat.size_diff > 0][: self.top]
+        rows = [
+            (
+                _site(stat.traceback),
+                stat.size_diff,
+                stat.count_diff,
+                stat.size,
+                stat.count,
+            )
+            for stat in growing
+        ]
+        with self._lock:
+            self.rows = rows
+            self.snapshots += 1
+            self.traced = tracemalloc.get_traced_memory()
+
+    def table(self):
+        with self._lock:
+            rows, snapshots, traced = self.rows, self.snapshots, self.traced
+        if not snapshots:
+            return "*Waiting for the first allocation snapshot...*"
+        lines = [
+            "*Traced memory: %.1f MB (peak %.1f MB), %d snapshots every %gs*"
+            % (traced[0] / KB / KB, traced[1] / KB / KB, snapshots, self.interval),
+            "",
+            "| Allocation site | Size delta (KB) | Count delta | Size (KB) | Count |",
+            "| --- | --- | --- | --- | --- |",
+        ]
+        for site, size_diff, count_diff, size, count in rows:
+            lines.append(
+                "| `%s` | %+.1f | %+d | %.1f | %d |"
+                % (site, size_diff / KB, count_diff, size / KB, count)
+            )
+        if not rows:
+            lines.append("| *no site grew since the previous snapshot* | | | | |")
+        return "\n".join(lines)
@@ -0,0 +1,277 @@
+"""
+Profiler backend reading /proc and the cgroup v2 files directly.
+
+Cheaper than going through psutil at high sampling rates (one read per file,
+no per-call object setup), and aware of the container's CPU quota and memory
+limit, which host-wide numbers ignore.
+"""
+import os
+
+CLOCK_TICKS = os.sysconf("SC_CLK_TCK")
+PAGE_SIZE = os.sysconf("SC_PAGE_SIZE")
+
+# Unit of the sector counts of /proc/diskstats, whatever the device.
+SECTOR_SIZE = 512
+
+# Used when /proc/self/mounts does not list a cgroup2 mount.
+CGROUP_ROOT = "/sys/fs/cgroup"
+
+
+def _read(path):
+    with open(path) as f:
+        return f.read()
+
+
+def _read_keys(path, keys):
+    # Values (first number) of `key:` or `key ` lines of a /proc file.
+    values = {}
+    with open(path) as f:
+        for line in f:
+            key, _, value = line.partition(":") if ":" in line else line.partition(" ")
+            if key in keys:
+                values[key] = int(value.split()[0])
+    return values
+
+
+def cpu_times():
+    # (total, busy) jiffies of the host from the first line of /proc/stat.
+    with open("/proc/stat") as f:
+        values = [int(value) for value in f.readline().split()[1:]]
+    # guest and guest_nice (after steal) are already accounted in user.
+    total = sum(values[:8])
+    return total, total - values[3] - values[4]
+
+
+def io_counters():
+    # The IO_COUNTERS of profiler_sampler from /proc/diskstats and
+    # /proc/net/dev. Only whole devices count (like psutil), not partitions.
+    read_bytes = write_bytes = reads = writes = 0
+    with open("/proc/diskstats") as f:
+        for line in f:
+            fields = line.split()
+            if not os.path.exists("/sys/block/" + fields[2].replace("/", "!")):
+                continue
+            reads += int(fields[3])
+            read_bytes += int(fields[5]) * SECTOR_SIZE
+            writes += int(fields[7])
+            write_bytes += int(fields[9]) * SECTOR_SIZE
+    rx = tx = 0
+    with open("/proc/net/dev") as f:
+        for line in f.readlines()[2:]:
+            name, _, values = line.partition(":")
+            if name.strip() == "lo":
+                continue
+            values = values.split()
+            rx += int(values[0])
+            tx += int(values[8])
+    return read_bytes, write_bytes, reads, writes, rx, tx
+
+
+class ProcfsHost:
+    """
+    Host metrics of `SystemSampler` from /proc and statvfs.
+    """
+
+    def __init__(self):
+        from profiler_sampler import CpuDelta, CounterRates
+
+        self.cpu = CpuDelta(cpu_times)
+        self.io = CounterRates(io_counters)
+        self._boot_time = None
+
+    def memory_percent(self):
+        info = _read_keys("/proc/meminfo", ("MemTotal", "MemAvailable"))
+        return 100.0 * (info["MemTotal"] - info["MemAvailable"]) / info["MemTotal"]
+
+    def disk_percent(self):
+        stat = os.statvfs("/")
+        used = (stat.f_blocks - stat.f_bfree) * stat.f_frsize
+        usable = used + stat.f_bavail * stat.f_frsize
+        return 100.0 * used / usable if usable else 0.0
+
+    def process_count(self):
+        return sum(1 for name in os.listdir("/proc") if name.isdigit())
+
+    def uptime(self, timestamp):
+        if self._boot_time is None:
+            self._boot_time = timestamp - float(_read("/proc/uptime").split()[0])
+        return timestamp - self._boot_time
+
+
+class ProcfsProcesses:
+    """
+    Per-process reads of `ProcessTreeSampler` from /proc/<pid>.
+    """
+
+    def children(self, root_pid):
+        parents = {}
+        for name in os.listdir("/proc"):
+            if not name.isdigit():
+                continue
+            try:
+                stat = _read("/proc/%s/stat" % name)
+            except (FileNotFoundError, ProcessLookupError):
+                continue
+            # The command name may contain spaces and parentheses.
+            ppid = int(stat[stat.rindex(")") + 2 :].split()[1])
+            parents.setdefault(ppid, []).append(int(name))
+        children = []
+        pending = [root_pid]
+        while pending:
+            kids = parents.get(pending.pop(), [])
+            children.extend(kids)
+            pending.extend(kids)
+        return children
+
+    def read(self, pid, read_uss):
+        # (cpu seconds, rss, uss or None, threads, open files, context
+        # switches, bytes read, bytes written)
+        root = "/proc/%d" % pid
+        try:
+            stat = _read(root + "/stat")
+            fields = stat[stat.rindex(")") + 2 :].split()
+            status = _read_keys(
+                root + "/status", ("voluntary_ctxt_switches", "nonvoluntary_ctxt_switches")
+            )
+            try:
+                fds = len(os.listdir(root + "/fd"))
+            except PermissionError:
+                fds = 0
+            try:
+                io = _read_keys(root + "/io", ("read_bytes", "write_bytes"))
+            except PermissionError:
+                io = {}
+            uss = None
+            if read_uss:
+                try:
+                    rollup = _read_keys(
+                        root + "/smaps_rollup", ("Private_Clean", "Private_Dirty")
+                    )
+                    uss = sum(rollup.values()) * 1024
+                except (PermissionError, FileNotFoundError):
+                    uss = 0
+        except (FileNotFoundError, ProcessLookupError):
+            return None
+        # Fields after the command name start at field 3 (state) of proc(5).
+        cpu = (int(fields[11]) + int(fields[12])) / CLOCK_TICKS
+        return (
+            cpu,
+            int(fields[21]) * PAGE_SIZE,
+            uss,
+            int(fields[17]),
+            fds,
+            sum(status.values()),
+            io.get("read_bytes", 0),
+            io.get("write_bytes", 0),
+        )
+
+
+def _cgroup2_mount():
+    with open("/proc/self/mounts") as f:
+        for line in f:
+            parts = line.split()
+            if len(parts) > 2 and parts[2] == "cgroup2":
+                return parts[1]
+    return CGROUP_ROOT
+
+
+class Cgroup:
+    """
+    The cgroup v2 of this process. Limits are the tightest ones set on it or
+    on any of its ancestors below the mount point.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.mount = _cgroup2_mount()
+
+    @classmethod
+    def detect(cls):
+        try:
+            with open("/proc/self/cgroup") as f:
+                for line in f:
+                    if line.startswith("0::"):
+                        path = _cgroup2_mount() + line[3:].strip().rstrip("/")
+                        # The root cgroup (e.g. on hybrid v1/v2 hosts) has
+                        # no memory.current and only mirrors the host.
+                        if os.path.exists(os.path.join(path, "memory.current")):
+                            return cls(path)
+        except FileNotFoundError:
+            pass
+        return None
+
+    def _ancestors(self):
+        path = self.path
+        while True:
+            yield path
+            if os.path.normpath(path) == os.path.normpath(self.mount):
+                return
+            path = os.path.dirname(path)
+
+    def _limit(self, fname, parse):
+        limits = []
+        for path in self._ancestors():
+            try:
+                value = _read(os.path.join(path, fname)).split()
+            except FileNotFoundError:
+                continue
+            if value and value[0] != "max":
+                limits.append(parse(value))
+        return min(limits) if limits else None
+
+    def cpu_limit(self):
+        # Cores the cgroup may use: its quota, else the CPUs it can run on.
+        quota = self._limit("cpu.max", lambda value: int(value[0]) / int(value[1]))
+        return quota or len(os.sched_getaffinity(0))
+
+    def memory_limit(self):
+        return self._limit("memory.max", lambda value: int(value[0]))
+
+    def cpu_stat(self):
+        return _read_keys(
+            os.path.join(self.path, "cpu.stat"), ("usage_usec", "throttled_usec")
+        )
+
+    def memory_current(self):
+        return int(_read(os.path.join(self.path, "memory.current")))
+
+
+class CgroupSampler:
+    """
+    Returns the fields of `CGROUP_FIELDS`: CPU used in percent of the quota,
+    the quota in cores, the time throttled in percent of the elapsed time
+    (summed over the cgroup's CPUs), and memory used against its limit (or
+    against the host memory when there is none, reported as a 0 limit).
+    """
+
+    def __init__(self, path, limits_interval):
+        self.cgroup = Cgroup(path)
+        self.limits_interval = limits_interval
+        self._limits = None
+        self._limits_read = None
+        self._last = None
+
+    def sample(self, now):
+        if self._limits is None or now - self._limits_read >= self.limits_interval:
+            memory_limit = self.cgroup.memory_limit()
+            host_memory = _read_keys("/proc/meminfo", ("MemTotal",))["MemTotal"] * 1024
+            self._limits = (self.cgroup.cpu_limit(), memory_limit, memory_limit or host_memory)
+            self._limits_read = now
+        cpu_limit, memory_limit, memory_max = self._limits
+        stat = self.cgroup.cpu_stat()
+        usage, throttled = stat.get("usage_usec", 0), stat.get("throttled_usec", 0)
+        cpu_percent = throttled_percent = 0.0
+        if self._last is not None and now > self._last[0]:
+            elapsed = (now - self._last[0]) * 1e6
+            cpu_percent = 100.0 * (usage - self._last[1]) / (elapsed * cpu_limit)
+            throttled_percent = 100.0 * (throttled - self._last[2]) / elapsed
+        self._last = (now, usage, throttled)
+        memory = self.cgroup.memory_current()
+        return (
+            cpu_percent,
+            cpu_limit,
+            throttled_percent,
+            memory,
+            memory_limit or 0,
+            100.0 * memory / memory_max,
+        )
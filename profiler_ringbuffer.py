@@ -0,0 +1,116 @@
+import struct
+from multiprocessing import shared_memory
+
+# Number of samples the ring holds before the writer overwrites unread ones.
+RING_CAPACITY = 4096
+
+# Header: number of records written so far, number of fields, capacity.
+_HEADER = struct.Struct("<QQQ")
+_SEQ = struct.Struct("<Q")
+
+
+class SampleRing:
+    """
+    Fixed-size ring of float64 records in shared memory, with one writer (the
+    sampler process) and one reader (the card updater).
+
+    Every slot starts with a sequence number: the writer makes it odd while it
+    writes the record and `2 * n + 2` once record `n` is complete, and only
+    then publishes `n + 1` as the write count. The reader checks the sequence
+    before and after copying a record, so neither side takes a lock and a
+    record overwritten while being read is detected instead of torn.
+    """
+
+    def __init__(self, fields, capacity=RING_CAPACITY, name=None, track=True):
+        self.fields = tuple(fields)
+        self.capacity = capacity
+        self._record = struct.Struct("<%dd" % len(self.fields))
+        self._slot_size = _SEQ.size + self._record.size
+        if name is None:
+            size = _HEADER.size + capacity * self._slot_size
+            self._shm = shared_memory.SharedMemory(create=True, size=size)
+            _HEADER.pack_into(self._shm.buf, 0, 0, len(self.fields), capacity)
+            self.owner = True
+        else:
+            self._shm = shared_memory.SharedMemory(name=name)
+            _, nfields, capacity = _HEADER.unpack_from(self._shm.buf, 0)
+            if (nfields, capacity) != (len(self.fields), self.capacity):
+                raise ValueError("Ring %s does not hold %d fields" % (name, len(self.fields)))
+            if not track:
+                # Only the creator unlinks the segment, not the resource
+                # tracker of an unrelated process that attached to it.
+                from multiprocessing import resource_tracker
+
+                resource_tracker.unregister(self._shm._name, "shared_memory")
+            self.owner = False
+        self.name = self._shm.name
+        # Write count of the writer, next record to read and records that
+        # were overwritten before the reader got to them.
+        self._head = 0
+        self._tail = 0
+        self.lost = 0
+
+    def __getstate__(self):
+        # Processes started with "spawn" attach to the same segment.
+        return (self.fields, self.capacity, self.name, self._head, self._tail)
+
+    def __setstate__(self, state):
+        fields, capacity, name, head, tail = state
+        self.__init__(fields, capacity, name=name)
+        self._head = head
+        self._tail = tail
+
+    def resume(self):
+        # A writer taking over from another one continues after its records.
+        self._head = _SEQ.unpack_from(self._shm.buf, 0)[0]
+
+    def _offset(self, n):
+        return _HEADER.size + (n % self.capacity) * self._slot_size
+
+    def write(self, values):
+        n = self._head
+        offset = self._offset(n)
+        buf = self._shm.buf
+        _SEQ.pack_into(buf, offset, 2 * n + 1)
+        self._record.pack_into(buf, offset + _SEQ.size, *values)
+        _SEQ.pack_into(buf, offset, 2 * n + 2)
+        self._head = n + 1
+        _SEQ.pack_into(buf, 0, n + 1)
+
+    def _skip_lost(self):
+        head = _SEQ.unpack_from(self._shm.buf, 0)[0]
+        if head - self._tail > self.capacity:
+            self.lost += head - self.capacity - self._tail
+            self._tail = head - self.capacity
+        return head
+
+    def drain(self, max_records=None):
+        """
+        Returns the records written since the previous call, oldest first, as
+        tuples in the order of `fields`.
+        """
+        buf = self._shm.buf
+        records = []
+        head = self._skip_lost()
+        while self._tail < head:
+            if max_records is not None and len(records) >= max_records:
+                break
+            offset = self._offset(self._tail)
+            expected = 2 * self._tail + 2
+            if _SEQ.unpack_from(buf, offset)[0] == expected:
+                values = self._record.unpack_from(buf, offset + _SEQ.size)
+                if _SEQ.unpack_from(buf, offset)[0] == expected:
+                    records.append(values)
+                    self._tail += 1
+                    continue
+            # The writer lapped us while we were reading this slot.
+            tail = self._tail
+            head = self._skip_lost()
+            if self._tail == tail:
+                break
+        return records
+
+    def close(self):
+        self._shm.close()
+        if self.owner:
+            self._shm.unlink()
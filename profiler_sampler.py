@@ -0,0 +1,447 @@
+import os
+import time
+
+# Fields of a sample in the ring shared by the sampler and the card updater.
+SAMPLE_FIELDS = (
+    "time",
+    "cpu",
+    "memory",
+    "disk",
+    "processes",
+    "load1",
+    "load5",
+    "load15",
+    "uptime",
+    "disk_read",
+    "disk_write",
+    "disk_read_iops",
+    "disk_write_iops",
+    "net_rx",
+    "net_tx",
+)
+
+# Cumulative host I/O counters behind the rates of the last SAMPLE_FIELDS:
+# disk bytes and operations read and written, network bytes received and
+# sent (loopback excluded).
+IO_COUNTERS = SAMPLE_FIELDS[-6:]
+
+# Task-wide totals of the processes of a task, in `scope="task"` mode.
+TASK_FIELDS = (
+    "task_cpu",
+    "task_rss",
+    "task_uss",
+    "task_threads",
+    "task_fds",
+    "task_ctx_switches",
+    "task_io_read",
+    "task_io_write",
+    "task_processes",
+)
+
+# Fields of each of the busiest processes of the task.
+PROCESS_FIELDS = (
+    "pid",
+    "cpu",
+    "rss",
+    "uss",
+    "threads",
+    "fds",
+    "ctx_switches",
+    "io_read",
+    "io_write",
+)
+
+# Container usage against its limits, with the "procfs" backend on cgroup v2.
+CGROUP_FIELDS = (
+    "cgroup_cpu",
+    "cgroup_cpu_limit",
+    "cgroup_throttled",
+    "cgroup_memory",
+    "cgroup_memory_limit",
+    "cgroup_memory_percent",
+)
+
+# Number of processes of the task broken down in each sample, busiest first.
+TOP_PROCESSES = 4
+
+# Seconds between two reads of the metrics that are slow to collect (disk
+# usage, number of processes, the process tree and its USS, cgroup limits);
+# samples in between repeat the last value.
+SLOW_METRICS_INTERVAL = 1.0
+
+# Accepted values of `backend` and `scope`.
+BACKENDS = ("psutil", "procfs")
+SCOPES = ("host", "task")
+
+
+def sample_fields(scope="host", top_processes=TOP_PROCESSES, cgroup=False):
+    fields = SAMPLE_FIELDS
+    if scope == "task":
+        fields += TASK_FIELDS + tuple(
+            "proc%d_%s" % (i, field)
+            for i in range(top_processes)
+            for field in PROCESS_FIELDS
+        )
+    if cgroup:
+        fields += CGROUP_FIELDS
+    return fields
+
+
+def detect_cgroup(backend):
+    # Path of the cgroup v2 the "procfs" backend reports on, if any.
+    if backend != "procfs":
+        return None
+    from profiler_procfs import Cgroup
+
+    cgroup = Cgroup.detect()
+    return cgroup.path if cgroup is not None else None
+
+
+def make_host(backend):
+    if backend == "procfs":
+        from profiler_procfs import ProcfsHost
+
+        return ProcfsHost()
+    return PsutilHost()
+
+
+def make_processes(backend):
+    if backend == "procfs":
+        from profiler_procfs import ProcfsProcesses
+
+        return ProcfsProcesses()
+    return PsutilProcesses()
+
+
+def make_cgroup(backend, cgroup_path):
+    if backend != "procfs" or not cgroup_path:
+        return None
+    from profiler_procfs import CgroupSampler
+
+    return CgroupSampler(cgroup_path, SLOW_METRICS_INTERVAL)
+
+
+def make_sampler(
+    interval,
+    backend="psutil",
+    scope="host",
+    root_pid=None,
+    top_processes=TOP_PROCESSES,
+    cgroup_path=None,
+    exclude=(),
+):
+    tree = None
+    if scope == "task":
+        tree = ProcessTreeSampler(
+            root_pid, make_processes(backend), top_processes, exclude=exclude
+        )
+    return SystemSampler(
+        interval,
+        make_host(backend),
+        tree=tree,
+        cgroup=make_cgroup(backend, cgroup_path),
+    )
+
+
+class CpuDelta:
+    """
+    CPU utilization over the time between two consecutive calls of `percent`,
+    from cumulative (total, busy) CPU times returned by `read`, so reading it
+    never blocks.
+    """
+
+    def __init__(self, read):
+        self._read = read
+        self._last = read()
+
+    def percent(self):
+        total, busy = self._read()
+        last_total, last_busy = self._last
+        self._last = (total, busy)
+        if total <= last_total:
+            return 0.0
+        return min(100.0, max(0.0, 100.0 * (busy - last_busy) / (total - last_total)))
+
+
+class CounterRates:
+    """
+    Per-second rates of the cumulative counters returned by `read`, from the
+    deltas since the previous call of `rates`; the first call returns zeros.
+    Counters that went backwards (e.g. a device that disappeared) give 0.
+    """
+
+    def __init__(self, read):
+        self._read = read
+        self._last = None
+
+    def rates(self, now):
+        values = self._read()
+        last = self._last
+        self._last = (now, values)
+        if last is None or now <= last[0]:
+            return (0.0,) * len(values)
+        elapsed = now - last[0]
+        return tuple(
+            max(0.0, (value - previous) / elapsed)
+            for value, previous in zip(values, last[1])
+        )
+
+
+def psutil_cpu_times():
+    import psutil
+
+    times = psutil.cpu_times()
+    # guest time is already accounted in user time on Linux.
+    total = sum(times) - getattr(times, "guest", 0) - getattr(times, "guest_nice", 0)
+    idle = times.idle + getattr(times, "iowait", 0)
+    return total, total - idle
+
+
+def psutil_io_counters():
+    import psutil
+
+    disk = psutil.disk_io_counters()
+    net = psutil.net_io_counters(pernic=True)
+    net.pop("lo", None)
+    return (
+        disk.read_bytes if disk else 0,
+        disk.write_bytes if disk else 0,
+        disk.read_count if disk else 0,
+        disk.write_count if disk else 0,
+        sum(nic.bytes_recv for nic in net.values()),
+        sum(nic.bytes_sent for nic in net.values()),
+    )
+
+
+class PsutilHost:
+    """
+    Host metrics of `SystemSampler` through psutil.
+    """
+
+    def __init__(self):
+        import psutil
+
+        self.cpu = CpuDelta(psutil_cpu_times)
+        self.io = CounterRates(psutil_io_counters)
+        self._boot_time = psutil.boot_time()
+
+    def memory_percent(self):
+        import psutil
+
+        return psutil.virtual_memory().percent
+
+    def disk_percent(self):
+        import psutil
+
+        return psutil.disk_usage("/").percent
+
+    def process_count(self):
+        import psutil
+
+        return len(psutil.pids())
+
+    def uptime(self, timestamp):
+        return timestamp - self._boot_time
+
+
+class PsutilProcesses:
+    """
+    Per-process reads of `ProcessTreeSampler` through psutil.
+    """
+
+    def __init__(self):
+        self._procs = {}
+
+    def _process(self, pid):
+        import psutil
+
+        proc = self._procs.get(pid)
+        if proc is None:
+            proc = self._procs[pid] = psutil.Process(pid)
+        return proc
+
+    def children(self, root_pid):
+        import psutil
+
+        try:
+            children = self._process(root_pid).children(recursive=True)
+        except psutil.NoSuchProcess:
+            return []
+        procs = {root_pid: self._procs[root_pid]}
+        for child in children:
+            # Known processes keep their object, which caches static info.
+            known = self._procs.get(child.pid)
+            procs[child.pid] = known if known == child else child
+        self._procs = procs
+        return [child.pid for child in children]
+
+    def read(self, pid, read_uss):
+        # (cpu seconds, rss, uss or None, threads, open files, context
+        # switches, bytes read, bytes written)
+        import psutil
+
+        try:
+            proc = self._process(pid)
+            with proc.oneshot():
+                cpu_times = proc.cpu_times()
+                rss = proc.memory_info().rss
+                threads = proc.num_threads()
+                fds = proc.num_fds() if hasattr(proc, "num_fds") else proc.num_handles()
+                ctx = sum(proc.num_ctx_switches())
+                try:
+                    io = proc.io_counters()
+                    io_read, io_write = io.read_bytes, io.write_bytes
+                except (psutil.AccessDenied, AttributeError):
+                    io_read = io_write = 0
+                uss = None
+                if read_uss:
+                    try:
+                        uss = proc.memory_full_info().uss
+                    except psutil.AccessDenied:
+                        uss = 0
+        except (psutil.NoSuchProcess, psutil.AccessDenied):
+            return None
+        return (
+            cpu_times.user + cpu_times.system,
+            rss,
+            uss,
+            threads,
+            fds,
+            ctx,
+            io_read,
+            io_write,
+        )
+
+
+class ProcessTreeSampler:
+    """
+    Metrics of the processes of a task: `root_pid` and all its descendants,
+    except the pids in `exclude` (the sampler itself), read through
+    `processes` (`PsutilProcesses` or `ProcfsProcesses`).
+
+    CPU is in percent of one core, context switches and I/O bytes per second,
+    all from the deltas since the previous sample of the same process. Returns the
+    totals of the task followed by the `top_processes` busiest processes,
+    padded with zeros.
+    """
+
+    def __init__(self, root_pid, processes, top_processes=TOP_PROCESSES, exclude=()):
+        self.root_pid = root_pid
+        self.processes = processes
+        self.top_processes = top_processes
+        self.exclude = set(exclude)
+        self._pids = [root_pid]
+        self._listed = None
+        # pid -> (time, cpu seconds, context switches, bytes read, bytes
+        # written) of the previous read.
+        self._last = {}
+        self._uss = {}
+
+    def _list(self, now):
+        if self._listed is not None and now - self._listed < SLOW_METRICS_INTERVAL:
+            return False
+        children = self.processes.children(self.root_pid)
+        self._pids = [self.root_pid] + [pid for pid in children if pid not in self.exclude]
+        pids = set(self._pids)
+        self._last = {pid: last for pid, last in self._last.items() if pid in pids}
+        self._uss = {pid: uss for pid, uss in self._uss.items() if pid in pids}
+        self._listed = now
+        return True
+
+    def _read(self, pid, now, read_uss):
+        values = self.processes.read(pid, read_uss)
+        if values is None:
+            return None
+        cpu, rss, uss, threads, fds, ctx, io_read, io_write = values
+        if uss is not None:
+            self._uss[pid] = uss
+        last = self._last.get(pid)
+        self._last[pid] = (now, cpu, ctx, io_read, io_write)
+        cpu_percent = ctx_rate = read_rate = write_rate = 0.0
+        if last is not None and now > last[0]:
+            elapsed = now - last[0]
+            cpu_percent = 100.0 * (cpu - last[1]) / elapsed
+            ctx_rate = (ctx - last[2]) / elapsed
+            read_rate = (io_read - last[3]) / elapsed
+            write_rate = (io_write - last[4]) / elapsed
+        return (
+            pid,
+            cpu_percent,
+            rss,
+            self._uss.get(pid, 0),
+            threads,
+            fds,
+            ctx_rate,
+            read_rate,
+            write_rate,
+        )
+
+    def sample(self, now):
+        read_uss = self._list(now)
+        rows = []
+        for pid in self._pids:
+            row = self._read(pid, now, read_uss)
+            if row is not None:
+                rows.append(row)
+        totals = [sum(row[i] for row in rows) for i in range(1, len(PROCESS_FIELDS))]
+        rows.sort(key=lambda row: row[1], reverse=True)
+        top = rows[: self.top_processes]
+        top += [(0,) * len(PROCESS_FIELDS)] * (self.top_processes - len(top))
+        return (*totals, len(rows), *(value for row in top for value in row))
+
+
+class SystemSampler:
+    """
+    Samples the host at a fixed rate on absolute deadlines.
+
+    Deadlines are `start + n * interval` on the monotonic clock, so the time
+    spent sampling does not add up into drift; deadlines that were missed are
+    skipped rather than sampled in a burst. Timestamps are the wall clock at
+    start plus the monotonic time elapsed, taken when the sample is read.
+    """
+
+    def __init__(self, interval, host, tree=None, cgroup=None):
+        self.interval = interval
+        self.host = host
+        self.tree = tree
+        self.cgroup = cgroup
+        self._slow = None
+        self._slow_read = None
+
+    def _slow_metrics(self, now):
+        if self._slow is None or now - self._slow_read >= SLOW_METRICS_INTERVAL:
+            self._slow = (self.host.disk_percent(), self.host.process_count())
+            self._slow_read = now
+        return self._slow
+
+    def sample(self, timestamp, now):
+        disk, processes = self._slow_metrics(now)
+        sample = (
+            timestamp,
+            self.host.cpu.percent(),
+            self.host.memory_percent(),
+            disk,
+            processes,
+            *os.getloadavg(),
+            self.host.uptime(timestamp),
+            *self.host.io.rates(now),
+        )
+        if self.tree is not None:
+            sample += self.tree.sample(now)
+        if self.cgroup is not None:
+            sample += self.cgroup.sample(now)
+        return sample
+
+    def run(self, ring):
+        start_wall = time.time()
+        start = time.monotonic()
+        n = 0
+        while True:
+            n += 1
+            delay = start + n * self.interval - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            else:
+                n += int(-delay // self.interval)
+            now = time.monotonic()
+            ring.write(self.sample(start_wall + (now - start), now))
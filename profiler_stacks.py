@@ -0,0 +1,163 @@
+import os
+import sys
+import threading
+
+# Seconds between two captures of the stacks of the step's threads.
+STACK_INTERVAL = 0.01
+
+# Nodes the stack trie holds at most; stacks that would need more are counted
+# under a "[truncated]" child of the deepest node that exists.
+MAX_STACK_NODES = 20000
+
+# Frames kept per stack, from the thread's entry point down.
+MAX_STACK_DEPTH = 128
+
+# Nodes under this share of all samples are left out of the flame graph.
+MIN_FLAME_FRACTION = 0.002
+
+TRUNCATED = "[truncated]"
+
+
+class StackNode:
+    __slots__ = ("name", "value", "children")
+
+    def __init__(self, name):
+        self.name = name
+        self.value = 0
+        self.children = {}
+
+
+class StackSampler:
+    """
+    Samples the Python stacks of every thread of the process from a
+    background thread (`sys._current_frames`) into a trie of folded stacks:
+    a node's value is the number of samples that went through it.
+
+    Samples are wall-clock: a thread blocked in a call is counted there too.
+    """
+
+    def __init__(
+        self,
+        interval=STACK_INTERVAL,
+        max_nodes=MAX_STACK_NODES,
+        max_depth=MAX_STACK_DEPTH,
+    ):
+        self.interval = interval
+        self.max_nodes = max_nodes
+        self.max_depth = max_depth
+        self.root = StackNode("all")
+        self.nodes = 1
+        self._labels = {}
+        self._ignored = set()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(
+            target=self._run, name="profiler-stacks", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def ignore_thread(self, ident):
+        # Threads of the profiler itself are left out of the samples.
+        self._ignored.add(ident)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.sample()
+
+    def _label(self, code):
+        label = self._labels.get(code)
+        if label is None:
+            label = self._labels[code] = "%s (%s:%d)" % (
+                code.co_name,
+                os.path.basename(code.co_filename),
+                code.co_firstlineno,
+            )
+        return label
+
+    def sample(self):
+        me = threading.get_ident()
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        frames = sys._current_frames()
+        with self._lock:
+            for ident, frame in frames.items():
+                if ident == me or ident in self._ignored:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(self._label(frame.f_code))
+                    frame = frame.f_back
+                stack.append(names.get(ident, "thread %d" % ident))
+                stack.reverse()
+                self._insert(stack[: self.max_depth])
+
+    def _insert(self, stack):
+        node = self.root
+        node.value += 1
+        for name in stack:
+            child = node.children.get(name)
+            if child is None and self.nodes >= self.max_nodes:
+                name = TRUNCATED
+                child = node.children.get(name)
+            if child is None:
+                child = node.children[name] = StackNode(name)
+                self.nodes += 1
+            child.value += 1
+            if name == TRUNCATED:
+                break
+            node = child
+
+    def folded(self):
+        """
+        The samples in the folded-stack format of flamegraph.pl: one
+        "frame;frame;frame count" line per stack, counting the samples that
+        ended there.
+        """
+        lines = []
+        with self._lock:
+            pending = [(self.root, ())]
+            while pending:
+                node, path = pending.pop()
+                own = node.value - sum(child.value for child in node.children.values())
+                if own > 0 and path:
+                    lines.append("%s %d" % (";".join(path), own))
+                for child in node.children.values():
+                    pending.append((child, path + (child.name,)))
+        return "\n".join(sorted(lines))
+
+    def rows(self, min_fraction=MIN_FLAME_FRACTION):
+        # Rectangles of the flame graph: [x0, x1) in samples and the depth.
+        rows = []
+        with self._lock:
+            total = self.root.value
+            if not total:
+                return rows
+            min_value = total * min_fraction
+            pending = [(self.root, 0, 0)]
+            while pending:
+                node, x0, depth = pending.pop()
+                rows.append(
+                    {
+                        "name": node.name,
+                        "x0": x0,
+                        "x1": x0 + node.value,
+                        "depth": depth,
+                        "value": node.value,
+                        "share": node.value / total,
+                        "total": total,
+                    }
+                )
+                x = x0
+                for name in sorted(node.children):
+                    child = node.children[name]
+                    if child.value >= min_value:
+                        pending.append((child, x, depth + 1))
+                    x += child.value
+        return rows
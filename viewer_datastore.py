@@ -0,0 +1,186 @@
+import os
+import queue
+import threading
+from collections import namedtuple
+from contextlib import contextmanager
+
+from metaflow import S3, metaflow_config
+
+# Number of long-lived S3 clients shared by the viewer threads.
+DATASTORE_POOL_SIZE = 8
+
+# `url` is what the viewer uses to address an object, `key` is its path
+# relative to the listed prefix (only set for listings; for non-recursive
+# listings, the name of the object or directory).
+StoreObject = namedtuple("StoreObject", "url key size last_modified")
+
+
+class S3Store(object):
+    """
+    Card datastore on S3, read through a pool of long-lived `S3` clients.
+
+    Creating an `S3()` sets up a temporary directory and a boto client; the
+    pool creates at most `pool_size` of them and hands them out to one thread
+    at a time, so that requests reuse their connections instead.
+    """
+
+    TYPE = "s3"
+
+    def __init__(self, root=None, pool_size=DATASTORE_POOL_SIZE):
+        self.root = root or metaflow_config.CARD_S3ROOT
+        self.pool_size = pool_size
+        self._pool = queue.LifoQueue()
+        self._created = 0
+        self._lock = threading.Lock()
+
+    def url(self, *parts):
+        return os.path.join(self.root, *parts)
+
+    @contextmanager
+    def _client(self):
+        try:
+            s3 = self._pool.get_nowait()
+        except queue.Empty:
+            with self._lock:
+                create = self._created < self.pool_size
+                if create:
+                    self._created += 1
+            if not create:
+                s3 = self._pool.get()
+            else:
+                try:
+                    s3 = S3()
+                except Exception:
+                    with self._lock:
+                        self._created -= 1
+                    raise
+        try:
+            yield s3
+        except Exception:
+            # Do not hand a client in an unknown state to the next request.
+            s3.close()
+            with self._lock:
+                self._created -= 1
+            raise
+        else:
+            self._pool.put(s3)
+
+    def info(self, url):
+        with self._client() as s3:
+            obj = s3.info(url, return_missing=True)
+        if not obj.exists:
+            return None
+        return StoreObject(url, None, obj.size, obj.last_modified)
+
+    def get(self, url):
+        with self._client() as s3:
+            obj = s3.get(url, return_missing=True)
+            # The client downloads into its temporary directory and only
+            # cleans it up on close, which pooled clients never do.
+            try:
+                return obj.blob if obj.exists else None
+            finally:
+                if obj.path is not None:
+                    try:
+                        os.unlink(obj.path)
+                    except FileNotFoundError:
+                        pass
+
+    def list(self, prefixes, recursive=True):
+        # All the prefixes go in one call, each call runs an s3op process.
+        prefixes = [os.path.join(prefix, "") for prefix in prefixes]
+        if not prefixes:
+            return
+        with self._client() as s3:
+            if recursive:
+                objs = s3.list_recursive(prefixes)
+            else:
+                objs = s3.list_paths(prefixes)
+        for obj in objs:
+            key = obj.key if recursive else obj.url.rstrip("/").rsplit("/", 1)[-1]
+            yield StoreObject(obj.url, key, obj.size, getattr(obj, "last_modified", None))
+
+    def close(self):
+        while True:
+            try:
+                self._pool.get_nowait().close()
+            except queue.Empty:
+                break
+
+
+class LocalStore(object):
+    """
+    Card datastore of `--datastore local`, read straight from the filesystem.
+    """
+
+    TYPE = "local"
+
+    def __init__(self, root=None):
+        self.root = (
+            root
+            or metaflow_config.CARD_LOCALROOT
+            or os.path.join(metaflow_config.DATASTORE_LOCAL_DIR, "mf.cards")
+        )
+
+    def url(self, *parts):
+        return os.path.join(self.root, *parts)
+
+    def info(self, url):
+        try:
+            stat = os.stat(url)
+        except FileNotFoundError:
+            return None
+        return StoreObject(url, None, stat.st_size, stat.st_mtime)
+
+    def get(self, url):
+        try:
+            with open(url, "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def open(self, url):
+        # Returns the open file and its metadata, taken from the descriptor so
+        # that they describe the same version of the file.
+        try:
+            f = open(url, "rb")
+        except FileNotFoundError:
+            return None, None
+        stat = os.fstat(f.fileno())
+        return f, StoreObject(url, None, stat.st_size, stat.st_mtime)
+
+    def list(self, prefixes, recursive=True):
+        for prefix in prefixes:
+            yield from self._list(prefix, recursive)
+
+    def _list(self, prefix, recursive):
+        if not recursive:
+            try:
+                entries = list(os.scandir(prefix))
+            except FileNotFoundError:
+                return
+            for entry in entries:
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                yield StoreObject(entry.path, entry.name, stat.st_size, stat.st_mtime)
+            return
+        for dirpath, _, filenames in os.walk(prefix):
+            for fname in filenames:
+                path = os.path.join(dirpath, fname)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                key = os.path.relpath(path, prefix).replace(os.sep, "/")
+                yield StoreObject(path, key, stat.st_size, stat.st_mtime)
+
+    def close(self):
+        pass
+
+
+def make_datastore(datastore_type, pool_size=DATASTORE_POOL_SIZE):
+    if datastore_type == LocalStore.TYPE:
+        return LocalStore()
+    return S3Store(pool_size=pool_size)
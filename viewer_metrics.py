@@ -0,0 +1,188 @@
+import time
+import bisect
+import threading
+from contextlib import contextmanager
+
+# Upper bounds (seconds) of the latency histogram buckets.
+LATENCY_BUCKETS = (
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+)
+
+PROMETHEUS_PREFIX = "card_viewer"
+
+
+class Histogram(object):
+    """
+    Fixed-bucket histogram; quantiles are interpolated within a bucket so the
+    memory used does not depend on the number of observations.
+    """
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q):
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for i, count in enumerate(self.counts):
+            if seen + count >= rank and count:
+                if i == len(self.buckets):
+                    return self.buckets[-1]
+                lower = self.buckets[i - 1] if i else 0.0
+                return lower + (self.buckets[i] - lower) * (rank - seen) / count
+            seen += count
+        return self.buckets[-1]
+
+    def summary(self):
+        return {
+            "count": self.count,
+            "sum": self.sum,
+            "p50": self.quantile(0.5),
+            "p95": self.quantile(0.95),
+            "p99": self.quantile(0.99),
+        }
+
+
+class Metrics(object):
+    """
+    Per-route request counts, latencies and bytes served, plus the time spent
+    in named operations (listing cards, metadata lookups, datastore reads).
+    """
+
+    def __init__(self):
+        self.started = time.time()
+        self._lock = threading.Lock()
+        self._requests = {}
+        self._bytes = {}
+        self._latency = {}
+        self._operations = {}
+        self._gauges = {}
+
+    def request(self, route, status, nbytes, seconds):
+        with self._lock:
+            key = (route, status)
+            self._requests[key] = self._requests.get(key, 0) + 1
+            self._bytes[route] = self._bytes.get(route, 0) + nbytes
+            self._latency.setdefault(route, Histogram()).observe(seconds)
+
+    def sent(self, route, nbytes):
+        # Bytes written outside of a request/response cycle (streams).
+        with self._lock:
+            self._bytes[route] = self._bytes.get(route, 0) + nbytes
+
+    def observe(self, operation, seconds):
+        with self._lock:
+            self._operations.setdefault(operation, Histogram()).observe(seconds)
+
+    @contextmanager
+    def timer(self, operation):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(operation, time.perf_counter() - start)
+
+    def add(self, gauge, delta):
+        with self._lock:
+            self._gauges[gauge] = self._gauges.get(gauge, 0) + delta
+
+    def snapshot(self, caches=None):
+        with self._lock:
+            uptime = time.time() - self.started
+            total = sum(self._requests.values())
+            # Streams only send bytes, they have no requests nor latency.
+            routes = {route: {"requests": {}, "bytes": 0} for route in self._bytes}
+            for (route, status), count in self._requests.items():
+                info = routes.setdefault(route, {"requests": {}, "bytes": 0})
+                info["requests"][str(status)] = count
+            for route, info in routes.items():
+                info["bytes"] = self._bytes.get(route, 0)
+                latency = self._latency.get(route)
+                info["latency"] = latency.summary() if latency is not None else None
+            return {
+                "uptime": uptime,
+                "requests": total,
+                "requests_per_second": total / uptime if uptime else 0.0,
+                "routes": routes,
+                "operations": {
+                    name: histogram.summary()
+                    for name, histogram in self._operations.items()
+                },
+                "gauges": dict(self._gauges),
+                "caches": caches or {},
+            }
+
+    def prometheus(self, caches=None):
+        # Prometheus text exposition format (version 0.0.4).
+        lines = []
+        with self._lock:
+            name = "%s_requests_total" % PROMETHEUS_PREFIX
+            lines.append("# TYPE %s counter" % name)
+            for (route, status), count in sorted(self._requests.items()):
+                lines.append('%s{route="%s",status="%s"} %d' % (name, route, status, count))
+            name = "%s_response_bytes_total" % PROMETHEUS_PREFIX
+            lines.append("# TYPE %s counter" % name)
+            for route, count in sorted(self._bytes.items()):
+                lines.append('%s{route="%s"} %d' % (name, route, count))
+            lines.extend(
+                _histogram_lines(
+                    "%s_request_duration_seconds" % PROMETHEUS_PREFIX,
+                    "route",
+                    self._latency,
+                )
+            )
+            lines.extend(
+                _histogram_lines(
+                    "%s_operation_duration_seconds" % PROMETHEUS_PREFIX,
+                    "operation",
+                    self._operations,
+                )
+            )
+            for gauge, value in sorted(self._gauges.items()):
+                name = "%s_%s" % (PROMETHEUS_PREFIX, gauge)
+                lines.append("# TYPE %s gauge" % name)
+                lines.append("%s %s" % (name, value))
+        for cache, stats in sorted((caches or {}).items()):
+            for stat, value in sorted(stats.items()):
+                name = "%s_%s_%s" % (PROMETHEUS_PREFIX, cache, stat)
+                lines.append("# TYPE %s gauge" % name)
+                lines.append("%s %s" % (name, value))
+        return "\n".join(lines) + "\n"
+
+
+def _histogram_lines(name, label, histograms):
+    lines = ["# TYPE %s histogram" % name]
+    for value, histogram in sorted(histograms.items()):
+        cumulative = 0
+        for bound, count in zip(histogram.buckets, histogram.counts):
+            cumulative += count
+            lines.append(
+                '%s_bucket{%s="%s",le="%s"} %d' % (name, label, value, bound, cumulative)
+            )
+        lines.append(
+            '%s_bucket{%s="%s",le="+Inf"} %d' % (name, label, value, histogram.count)
+        )
+        lines.append('%s_sum{%s="%s"} %s' % (name, label, value, histogram.sum))
+        lines.append('%s_count{%s="%s"} %d' % (name, label, value, histogram.count))
+    return lines